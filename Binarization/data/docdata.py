@@ -62,3 +62,25 @@ class DocData(Dataset):
         name = self.data_img[idx]
         #print(f"Processing: {name}\n")
         return img, gt, name
+
+
+def read_image(path):
+    """
+    Read a grayscale page without its ground truth, as a (1, 1, H, W) tensor in [0, 1].
+    Returns None if the file can not be decoded.
+    """
+    img = cv2.imread(path, 0)
+    if img is None:
+        return None
+    return ToTensor()(img).unsqueeze(0)
+
+
+def decode_image(data):
+    """
+    Decode an encoded (PNG, JPEG, BMP, TIFF...) page from bytes, as a grayscale (1, 1, H, W) tensor in [0, 1].
+    Returns None if the data can not be decoded.
+    """
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    return ToTensor()(img).unsqueeze(0)
@@ -6,6 +6,11 @@ import math
 from typing import Optional, Tuple, Union, List
 import numpy as np
 from Binarization.model.local_arch import Local_Base
+from Binarization.model.NAFNET import NAFBlock as PlainNAFBlock
+from Binarization.model.slimmable import slim_conv2d, slim_layer_norm
+
+#KEEP THE EINOPS CALLS AS LEAVES WHEN THE NETWORK IS TRACED WITH torch.fx (INT8 QUANTIZATION)
+torch.fx.wrap('rearrange')
 
 # sinusoidal positional embeds
 class SinusoidalPosEmb(nn.Module):
@@ -79,6 +84,8 @@ class NAFBlock(nn.Module):
 
         self.beta = nn.Parameter(torch.zeros((1, c, 1, 1)), requires_grad=True)
         self.gamma = nn.Parameter(torch.zeros((1, c, 1, 1)), requires_grad=True)
+        #SLIMMABLE WIDTH (SEE slimmable.set_width)
+        self.width_mult = 1.
 
     def time_forward(self, time, mlp):
         time_emb = mlp(time)
@@ -87,7 +94,13 @@ class NAFBlock(nn.Module):
 
     def forward(self, x):
         inp, time = x
-        shift_att, scale_att, shift_ffn, scale_ffn = self.time_forward(time, self.mlp)
+        if isinstance(time, dict):
+            #PRECOMPUTED MODULATION (SEE ConditionalNAFNet.enable_time_cache)
+            shift_att, scale_att, shift_ffn, scale_ffn = time[self]
+        else:
+            shift_att, scale_att, shift_ffn, scale_ffn = self.time_forward(time, self.mlp)
+        if self.width_mult != 1:
+            return self.slim_forward(inp, shift_att, scale_att, shift_ffn, scale_ffn), time
 
         x = inp
 
@@ -115,13 +128,80 @@ class NAFBlock(nn.Module):
 
         return x, time
 
+    def slim_forward(self, inp, shift_att, scale_att, shift_ffn, scale_ffn):
+        #forward ON THE FIRST inp.shape[1] CHANNELS OF THE BLOCK, THE TIME MODULATION IS COMPUTED AT FULL WIDTH
+        c = inp.shape[1]
+        dw_channel = self.conv1.out_channels * c // self.conv3.out_channels
+        ffn_channel = self.conv4.out_channels * c // self.conv5.out_channels
+
+        x = slim_layer_norm(self.norm1, inp)
+        x = x * (scale_att[:, :c] + 1) + shift_att[:, :c]
+        x = slim_conv2d(self.conv1, x, dw_channel, chunks=2)
+        x = slim_conv2d(self.conv2, x, dw_channel, chunks=2)
+        x = self.sg(x)
+        x = x * slim_conv2d(self.sca[1], self.sca[0](x), c)
+        x = slim_conv2d(self.conv3, x, c)
+
+        x = self.dropout1(x)
+
+        y = inp + x * self.beta[:, :c]
+
+        x = slim_layer_norm(self.norm2, y)
+        x = x * (scale_ffn[:, :c] + 1) + shift_ffn[:, :c]
+        x = slim_conv2d(self.conv4, x, ffn_channel, chunks=2)
+        x = self.sg(x)
+        x = slim_conv2d(self.conv5, x, c)
+
+        x = self.dropout2(x)
+
+        return y + x * self.gamma[:, :c]
+
+
+class ConditionEncoder(nn.Module):
+    """
+    Lightweight multi-scale encoder of the condition (one time independent NAFBlock per level).
+    Returns the features added to the input of every encoder level and of the middle blocks of ConditionalNAFNet;
+    at full resolution they stand in for the NAFBlocks of the denoiser, which has none at that level.
+    """
+
+    def __init__(self, cond_channel, width, levels):
+        super().__init__()
+        self.intro = nn.Conv2d(in_channels=cond_channel, out_channels=width, kernel_size=3, padding=1, stride=1, groups=1,
+                               bias=True)
+        self.blocks = nn.ModuleList()
+        self.downs = nn.ModuleList()
+        chan = width
+        for _ in range(levels):
+            self.blocks.append(PlainNAFBlock(chan))
+            self.downs.append(nn.Conv2d(chan, 2*chan, 2, 2))
+            chan = chan * 2
+        self.blocks.append(PlainNAFBlock(chan))
+        #SLIMMABLE WIDTH (SEE slimmable.set_width)
+        self.width_mult = 1.
+
+    def forward(self, cond):
+        slim = self.width_mult != 1
+        x = self.intro(cond) if not slim else slim_conv2d(self.intro, cond, int(self.intro.out_channels * self.width_mult))
+        features = []
+        for block, down in zip(self.blocks, self.downs):
+            x = block(x)
+            features.append(x)
+            x = down(x) if not slim else slim_conv2d(down, x, 2 * x.shape[1])
+        features.append(self.blocks[-1](x))
+        return features
+
 
 class ConditionalNAFNet(nn.Module):
 
-    def __init__(self, inp_channel=3, out_channel=1, width=16, middle_blk_num=1, enc_blk_nums=[], dec_blk_nums=[], upscale=1):
+    def __init__(self, inp_channel=3, out_channel=1, width=16, middle_blk_num=1, enc_blk_nums=[], dec_blk_nums=[], upscale=1,
+                 cond_encoder=False, unshuffle=1):
         super().__init__()
         self.img_channel= inp_channel
         self.upscale = upscale
+        #unshuffle > 1: THE NETWORK RUNS ON A unshuffle x unshuffle SMALLER GRID (SPACE TO DEPTH BEFORE intro,
+        #DEPTH TO SPACE AFTER ending)
+        self.unshuffle = unshuffle
+        depth = unshuffle * unshuffle
         fourier_dim = width
         sinu_pos_emb = SinusoidalPosEmb(fourier_dim)
         time_dim = width * 4
@@ -133,10 +213,18 @@ class ConditionalNAFNet(nn.Module):
             nn.Linear(time_dim, time_dim)
         )
         
-        self.intro = nn.Conv2d(in_channels=inp_channel, out_channels=width, kernel_size=3, padding=1, stride=1, groups=1,
-                              bias=True)
-        self.ending = nn.Conv2d(in_channels=width, out_channels=out_channel, kernel_size=3, padding=1, stride=1, groups=1,
-                              bias=True)
+        #cond_encoder: THE CONDITION (out_channel CHANNELS OF THE inp_channel) GOES THROUGH ITS OWN ENCODER,
+        #COMPUTED ONCE PER SAMPLE, INSTEAD OF BEING CONCATENATED TO THE NOISY INPUT AT EVERY STEP. ITS FULL
+        #RESOLUTION FEATURES REPLACE THE NAFBlocks OF THE FULL RESOLUTION LEVEL, SO EACH STEP ONLY RUNS
+        #intro, ending AND THE UP/DOWN CONVOLUTIONS AT FULL RESOLUTION
+        if cond_encoder and enc_blk_nums:
+            enc_blk_nums, dec_blk_nums = [0] + list(enc_blk_nums[1:]), list(dec_blk_nums[:-1]) + [0]
+        self.cond_encoder = ConditionEncoder(out_channel * depth, width, len(enc_blk_nums)) if cond_encoder else None
+        self.cond_cache = None
+        self.intro = nn.Conv2d(in_channels=(inp_channel - out_channel if cond_encoder else inp_channel) * depth,
+                               out_channels=width, kernel_size=3, padding=1, stride=1, groups=1, bias=True)
+        self.ending = nn.Conv2d(in_channels=width, out_channels=out_channel * depth, kernel_size=3, padding=1, stride=1,
+                                groups=1, bias=True)
 
         self.encoders = nn.ModuleList()
         self.decoders = nn.ModuleList()
@@ -175,7 +263,85 @@ class ConditionalNAFNet(nn.Module):
                 )
             )
 
-        self.padder_size = 2 ** len(self.encoders)
+        self.padder_size = unshuffle * 2 ** len(self.encoders)
+        self.time_cache = None
+        self.feature_cache = None
+        #SLIMMABLE WIDTH (SEE slimmable.set_width)
+        self.width_mult = 1.
+
+    def enable_time_cache(self, max_entries=256):
+        """
+        Inference only: memoize the time modulation (time_mlp and the scale/shift of every NAFBlock)
+        per timestep, so the denoiser calls of a fixed solver schedule only do the convolutional work.
+        Used for batches sharing the same timestep, at most `max_entries` timesteps are stored.
+        """
+        self.time_cache = {}
+        self.time_cache_size = max_entries
+
+    def disable_time_cache(self):
+        self.time_cache = None
+
+    def enable_feature_cache(self, depth, schedule=2):
+        """
+        Inference only: reuse the deep features across the denoiser calls of a sample (DeepCache).
+        A full call stores the input of the `depth` shallowest decoder levels, the other calls only run the
+        `depth` shallowest encoder and decoder levels on top of it. `schedule` is either N (a full call every
+        N calls) or the list of the call indices computed in full. The call index restarts at reset_feature_cache.
+        """
+        if not 0 < depth < len(self.encoders):
+            raise ValueError(f"Feature cache depth must be in [1, {len(self.encoders) - 1}], got {depth}")
+        self.feature_cache = {'depth': depth, 'schedule': schedule, 'calls': 0, 'features': None, 'shape': None}
+        self.feature_cache_stats = {'full': 0, 'reused': 0}
+
+    def reset_feature_cache(self):
+        #CALLED BEFORE EACH SAMPLE, THE FIRST CALL IS ALWAYS FULL
+        if self.feature_cache is not None:
+            self.feature_cache.update(calls=0, features=None, shape=None)
+
+    def disable_feature_cache(self):
+        self.feature_cache = None
+
+    def reuse_features(self, x):
+        #True IF THIS CALL REUSES THE DEEP FEATURES OF THE LAST FULL CALL
+        cache = self.feature_cache
+        call = cache['calls']
+        cache['calls'] += 1
+        schedule = cache['schedule']
+        full = call % schedule == 0 if isinstance(schedule, int) else call == 0 or call in schedule
+        #A BATCH OF ANOTHER SHAPE (E.G. COMPACTED BY THE EARLY STOP) NEEDS A FULL CALL
+        reuse = not full and cache['features'] is not None and cache['shape'] == x.shape
+        self.feature_cache_stats['reused' if reuse else 'full'] += 1
+        return reuse
+
+    def condition_features(self, cond):
+        #THE CONDITION DOES NOT CHANGE DURING SAMPLING: ENCODED ONCE AND REUSED WHILE THE SAME TENSOR IS PASSED
+        if torch.is_grad_enabled():
+            return self.cond_encoder(self.space_to_depth(self.check_image_size(cond)))
+        if self.cond_cache is None or self.cond_cache[0] is not cond or self.cond_cache[1] != self.width_mult:
+            self.cond_cache = (cond, self.width_mult, self.cond_encoder(self.space_to_depth(self.check_image_size(cond))))
+        return self.cond_cache[2]
+
+    def space_to_depth(self, x):
+        return F.pixel_unshuffle(x, self.unshuffle) if self.unshuffle > 1 else x
+
+    def time_modulation(self, time):
+        """
+        Returns {NAFBlock: (shift_att, scale_att, shift_ffn, scale_ffn)} for the timesteps `time`.
+        """
+        t = self.time_mlp(time)
+        return {block: block.time_forward(t, block.mlp) for block in self.modules() if isinstance(block, NAFBlock)}
+
+    def cached_time(self, time):
+        #LOOK UP (OR COMPUTE AND STORE) THE MODULATION OF A BATCH WITH A SINGLE TIMESTEP
+        if time.dim() > 0 and not bool((time == time[0]).all()):
+            return self.time_mlp(time)
+        key = float(time.reshape(-1)[0])
+        table = self.time_cache.get(key)
+        if table is None:
+            table = self.time_modulation(time.reshape(-1)[:1])
+            if len(self.time_cache) < self.time_cache_size:
+                self.time_cache[key] = table
+        return table
 
     def forward(self, inp,  time, cond):
         inp_res = inp.clone()
@@ -184,31 +350,55 @@ class ConditionalNAFNet(nn.Module):
             time = torch.tensor([time]).to(inp.device)
 
         x = inp 
-        x = torch.cat([x, cond], dim=1)
+        if self.cond_encoder is not None:
+            conds = self.condition_features(cond)
+        else:
+            x = torch.cat([x, cond], dim=1)
 
 
-        t = self.time_mlp(time)
+        if self.time_cache is not None and not torch.is_grad_enabled():
+            t = self.cached_time(time)
+        else:
+            t = self.time_mlp(time)
 
         B, C, H, W = x.shape
         x = self.check_image_size(x)
+        x = self.space_to_depth(x)
+        slim = self.width_mult != 1
 
-        x = self.intro(x)
+        x = self.intro(x) if not slim else slim_conv2d(self.intro, x, int(self.intro.out_channels * self.width_mult))
 
         encs = []
+        caching = self.feature_cache is not None and not torch.is_grad_enabled()
+        reuse = caching and self.reuse_features(x)
+        levels = self.feature_cache['depth'] if reuse else len(self.encoders)
 
-        for encoder, down in zip(self.encoders, self.downs):
+        for level, (encoder, down) in enumerate(zip(self.encoders[:levels], self.downs[:levels])):
+            if self.cond_encoder is not None:
+                x = x + conds[level]
             x, _ = encoder([x, t])
             encs.append(x)
-            x = down(x)
-
-        x, _ = self.middle_blks([x, t])
-
-        for decoder, up, enc_skip in zip(self.decoders, self.ups, encs[::-1]):
-            x = up(x)
+            if len(encs) < levels or not reuse:
+                x = down(x) if not slim else slim_conv2d(down, x, 2 * x.shape[1])
+
+        if reuse:
+            #DEEP FEATURES OF THE LAST FULL CALL
+            x = self.feature_cache['features']
+        else:
+            x = x + conds[-1] if self.cond_encoder is not None else x
+            x, _ = self.middle_blks([x, t])
+
+        first = len(self.decoders) - levels
+        for level, (decoder, up, enc_skip) in enumerate(zip(self.decoders[first:], self.ups[first:], encs[::-1]), first):
+            if caching and not reuse and level == len(self.decoders) - self.feature_cache['depth']:
+                self.feature_cache.update(features=x, shape=encs[0].shape)
+            x = up(x) if not slim else up[1](slim_conv2d(up[0], x, 2 * x.shape[1]))
             x = x + enc_skip
             x, _ = decoder([x, t])
 
-        x = self.ending(x)
+        x = self.ending(x) if not slim else slim_conv2d(self.ending, x, self.ending.out_channels)
+        if self.unshuffle > 1:
+            x = F.pixel_shuffle(x, self.unshuffle)
 
         x = x[..., :H, :W]
 
@@ -12,7 +12,8 @@ from torchvision.transforms.functional import rgb_to_grayscale
 #DocDiffNAFNET
 class NAFDPM(nn.Module):
     def __init__(self, input_channels: int = 2, output_channels: int = 1, n_channels: int = 32,
-                 middle_blk_num: int = 1, enc_blk_nums=[1, 1, 1, 28], dec_blk_nums=[1, 1, 1, 1], mode=1):
+                 middle_blk_num: int = 1, enc_blk_nums=[1, 1, 1, 28], dec_blk_nums=[1, 1, 1, 1], mode=1,
+                 cond_encoder=False, unshuffle=1):
         super(NAFDPM, self).__init__()
         #Mode Test
         if mode == 0: 
@@ -22,7 +23,9 @@ class NAFDPM(nn.Module):
                                            middle_blk_num=middle_blk_num, 
                                            enc_blk_nums=enc_blk_nums, 
                                            dec_blk_nums=dec_blk_nums, 
-                                           upscale=1)
+                                           upscale=1,
+                                           cond_encoder=cond_encoder,
+                                           unshuffle=unshuffle)
         #Mode Train
         else: 
             self.denoiser  = ConditionalNAFNet(inp_channel= output_channels*2, 
@@ -31,7 +34,9 @@ class NAFDPM(nn.Module):
                                            middle_blk_num=middle_blk_num, 
                                            enc_blk_nums=enc_blk_nums, 
                                            dec_blk_nums=dec_blk_nums, 
-                                           upscale=1)
+                                           upscale=1,
+                                           cond_encoder=cond_encoder,
+                                           unshuffle=unshuffle)
         #Mode Test
         if mode == 0:
             self.init_predictor = NAFNetLocal(      inp_channel=input_channels, 
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from Binarization.model.local_arch import Local_Base
+from Binarization.model.slimmable import slim_conv2d, slim_layer_norm
 
 class LayerNorm(nn.Module):
     def __init__(self, dim):
@@ -51,8 +52,12 @@ class NAFBlock(nn.Module):
 
         self.beta = nn.Parameter(torch.zeros((1, c, 1, 1)), requires_grad=True)
         self.gamma = nn.Parameter(torch.zeros((1, c, 1, 1)), requires_grad=True)
+        #SLIMMABLE WIDTH (SEE slimmable.set_width)
+        self.width_mult = 1.
 
     def forward(self, inp):
+        if self.width_mult != 1:
+            return self.slim_forward(inp)
         x = inp
 
         x = self.norm1(x)
@@ -75,6 +80,32 @@ class NAFBlock(nn.Module):
 
         return y + x * self.gamma
 
+    def slim_forward(self, inp):
+        #forward ON THE FIRST inp.shape[1] CHANNELS OF THE BLOCK
+        c = inp.shape[1]
+        dw_channel = self.conv1.out_channels * c // self.conv3.out_channels
+        ffn_channel = self.conv4.out_channels * c // self.conv5.out_channels
+
+        x = slim_layer_norm(self.norm1, inp)
+
+        x = slim_conv2d(self.conv1, x, dw_channel, chunks=2)
+        x = slim_conv2d(self.conv2, x, dw_channel, chunks=2)
+        x = self.sg(x)
+        x = x * slim_conv2d(self.sca[1], self.sca[0](x), c)
+        x = slim_conv2d(self.conv3, x, c)
+
+        x = self.dropout1(x)
+
+        y = inp + x * self.beta[:, :c]
+
+        x = slim_conv2d(self.conv4, slim_layer_norm(self.norm2, y), ffn_channel, chunks=2)
+        x = self.sg(x)
+        x = slim_conv2d(self.conv5, x, c)
+
+        x = self.dropout2(x)
+
+        return y + x * self.gamma[:, :c]
+
 
 class NAFNet(nn.Module):
 
@@ -124,28 +155,31 @@ class NAFNet(nn.Module):
             )
 
         self.padder_size = 2 ** len(self.encoders)
+        #SLIMMABLE WIDTH (SEE slimmable.set_width)
+        self.width_mult = 1.
 
     def forward(self, inp):
         B, C, H, W = inp.shape
         inp = self.check_image_size(inp)
+        slim = self.width_mult != 1
 
-        x = self.intro(inp)
+        x = self.intro(inp) if not slim else slim_conv2d(self.intro, inp, int(self.intro.out_channels * self.width_mult))
 
         encs = []
 
         for encoder, down in zip(self.encoders, self.downs):
             x = encoder(x)
             encs.append(x)
-            x = down(x)
+            x = down(x) if not slim else slim_conv2d(down, x, 2 * x.shape[1])
 
         x = self.middle_blks(x)
 
         for decoder, up, enc_skip in zip(self.decoders, self.ups, encs[::-1]):
-            x = up(x)
+            x = up(x) if not slim else up[1](slim_conv2d(up[0], x, 2 * x.shape[1]))
             x = x + enc_skip
             x = decoder(x)
 
-        x = self.ending(x)
+        x = self.ending(x) if not slim else slim_conv2d(self.ending, x, self.ending.out_channels)
         x = x + inp
 
         return x[:, :, :H, :W]
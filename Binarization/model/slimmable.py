@@ -0,0 +1,46 @@
+import torch
+import torch.nn.functional as F
+
+
+def slim_conv2d(conv, x, out_channels, chunks=1):
+    """
+    `conv` restricted to the channels of a slimmed network: its first x.shape[1] input channels, and
+    `out_channels` output channels taken as the first out_channels // chunks of each of its `chunks`
+    output chunks (outputs later split with chunk(), e.g. by SimpleGate). Depthwise convolutions keep
+    one group per input channel.
+    """
+    weight, bias = conv.weight, conv.bias
+    if out_channels != conv.out_channels:
+        shape = weight.shape[1:]
+        weight = weight.reshape(chunks, -1, *shape)[:, :out_channels // chunks].reshape(out_channels, *shape)
+        bias = None if bias is None else bias.reshape(chunks, -1)[:, :out_channels // chunks].reshape(-1)
+    if conv.groups == 1:
+        weight, groups = weight[:, :x.shape[1]], 1
+    else:
+        groups = x.shape[1]
+    return F.conv2d(x, weight, bias, conv.stride, conv.padding, conv.dilation, groups)
+
+
+def slim_layer_norm(norm, x):
+    #CHANNEL LayerNorm OF NAFNet/ConditionalNAFNet ON THE FIRST x.shape[1] CHANNELS
+    eps = 1e-5 if x.dtype == torch.float32 else 1e-3
+    var = torch.var(x, dim=1, unbiased=False, keepdim=True)
+    mean = torch.mean(x, dim=1, keepdim=True)
+    return (x - mean) * (var + eps).rsqrt() * norm.g[:, :x.shape[1]]
+
+
+def set_width(network, width_mult):
+    """
+    Run the NAFNet/ConditionalNAFNet modules of `network` with `width_mult` times their channels
+    (the first channels of every layer, shared with the full network), 1 for the full network.
+    Sub-networks only give useful results for widths the network was trained with (SLIM_WIDTHS).
+    """
+    for module in network.modules():
+        if hasattr(module, 'intro') and hasattr(module, 'width_mult'):
+            channels = module.intro.out_channels * width_mult
+            if not 0 < width_mult <= 1 or channels != int(channels):
+                raise ValueError(f"Width {width_mult} does not give an integer number of channels "
+                                 f"for a width of {module.intro.out_channels}")
+    for module in network.modules():
+        if hasattr(module, 'width_mult'):
+            module.width_mult = width_mult
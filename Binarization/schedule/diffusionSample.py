@@ -45,6 +45,7 @@ class GaussianDiffusion(nn.Module):
         self.register_buffer('gammas', gammas)
         self.register_buffer('sqrt_one_minus_gammas', np.sqrt(1 - gammas))
         self.register_buffer('sqrt_gammas', np.sqrt(gammas))
+        self.plans = {}
 
     def predict_xt_prev_mean_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
@@ -67,32 +68,76 @@ class GaussianDiffusion(nn.Module):
         y_noisy = extract_(self.sqrt_gammas, t, y.shape) * y + extract_(self.sqrt_one_minus_gammas, t, noise.shape) * noise
         return y_noisy, noise
 
-    def forward(self, x_T, cond, pre_ori='False'):
+    def sampling_timesteps(self, steps=None, skip_type='uniform'):
         """
-        Algorithm 2.
+        Timesteps visited by the sampler, in decreasing order: all the T timesteps if `steps` is None or 0,
+        `steps` timesteps from T - 1 down to 0 evenly spaced ('uniform') or denser near 0 ('quadratic'),
+        or the list `steps` itself. A grid of `steps` timesteps always has exactly `steps` distinct timesteps
+        and starts at T - 1.
         """
-        x_t = x_T
-        cond_ = cond
-        for time_step in reversed(range(self.T)):
-            #print("time_step: ", time_step)
-            t = x_t.new_ones([x_T.shape[0], ], dtype=torch.long) * time_step
-            if pre_ori == 'False':
-                mean, var = self.p_mean_variance(x_t=x_t, t=t, cond_=cond_)
-                if time_step > 0:
-                    noise = torch.randn_like(x_t)
-                else:
-                    noise = 0
-                x_t = mean + torch.sqrt(var) * noise
-                assert torch.isnan(x_t).int().sum() == 0, "nan in tensor."
+        if isinstance(steps, (list, tuple)):
+            timesteps = np.unique(np.array(steps, dtype=np.int64))[::-1]
+        elif not steps or steps >= self.T:
+            timesteps = np.arange(self.T)[::-1]
+        else:
+            if skip_type == 'uniform':
+                timesteps = np.linspace(self.T - 1, 0, steps)
+            elif skip_type == 'quadratic':
+                timesteps = np.linspace(np.sqrt(self.T - 1), 0, steps) ** 2
             else:
-                if time_step > 0:
-                    ori = self.model(x_t, t, cond_ )
-                    eps = x_t - extract_(self.sqrt_gammas, t, ori.shape) * ori
-                    eps = eps / extract_(self.sqrt_one_minus_gammas, t, eps.shape)
-                    x_t = extract_(self.sqrt_gammas, t - 1, ori.shape) * ori + extract_(self.sqrt_one_minus_gammas, t - 1, eps.shape) * eps
+                raise ValueError("Unsupported skip type {}, need to be 'uniform' or 'quadratic'".format(skip_type))
+            timesteps = np.round(timesteps).astype(np.int64)
+            #TIMESTEPS ROUNDED TO THE SAME INTEGER (QUADRATIC GRID NEAR 0) ARE SPREAD TO THE NEIGHBOURING ONES:
+            #STRICTLY DECREASING FROM THE TOP, THEN AT LEAST steps - 1 - i FOR THE i-TH ONE FROM THE BOTTOM
+            for i in range(1, steps):
+                timesteps[i] = min(timesteps[i], timesteps[i - 1] - 1)
+            timesteps = np.maximum(timesteps, np.arange(steps - 1, -1, -1))
+        assert timesteps[-1] >= 0 and timesteps[0] < self.T, "sampling timesteps must be in [0, TIMESTEPS)"
+        return timesteps.tolist()
+
+    def plan(self, steps=None, skip_type='uniform', pre_ori='False'):
+        """
+        Coefficients (t, a, b, sigma) of each sampling step x <- a * x + b * model(x, t) + sigma * noise.
+        With all the timesteps and pre_ori 'False' this is the ancestral (DDPM) sampler, otherwise the
+        deterministic DDIM update from t to the next visited timestep (x0 prediction if pre_ori is 'True').
+        The plans are computed once and cached.
+        """
+        timesteps = self.sampling_timesteps(steps, skip_type)
+        key = (tuple(timesteps), pre_ori)
+        if key not in self.plans:
+            gammas = self.gammas.double().cpu().numpy()
+            var = torch.cat([self.posterior_var[1:2], self.betas[1:]]).double().cpu().numpy()
+            coeff1, coeff2 = self.coeff1.double().cpu().numpy(), self.coeff2.double().cpu().numpy()
+            ancestral = pre_ori == 'False' and len(timesteps) == self.T
+            plan = []
+            for i, t in enumerate(timesteps):
+                if ancestral:
+                    plan.append((t, coeff1[t], -coeff2[t], np.sqrt(var[t]) if t > 0 else 0.))
+                    continue
+                #gamma OF THE NEXT VISITED TIMESTEP, 1 AFTER THE LAST ONE (x_0)
+                gamma_prev = gammas[timesteps[i + 1]] if i + 1 < len(timesteps) else 1.
+                if pre_ori == 'True':
+                    a = np.sqrt(1. - gamma_prev) / np.sqrt(1. - gammas[t])
+                    b = np.sqrt(gamma_prev) - a * np.sqrt(gammas[t])
                 else:
-                    x_t = self.model(x_t,t, cond_)
+                    a = np.sqrt(gamma_prev) / np.sqrt(gammas[t])
+                    b = np.sqrt(1. - gamma_prev) - a * np.sqrt(1. - gammas[t])
+                plan.append((t, a, b, 0.))
+            self.plans[key] = [(t, float(a), float(b), float(sigma)) for t, a, b, sigma in plan]
+        return self.plans[key]
 
+    def forward(self, x_T, cond, pre_ori='False', steps=None, skip_type='uniform'):
+        """
+        Algorithm 2, or strided DDIM with `steps` (see sampling_timesteps). Runs on the device of x_T.
+        """
+        x_t = x_T
+        for time_step, a, b, sigma in self.plan(steps, skip_type, pre_ori):
+            t = torch.full((x_t.shape[0],), time_step, dtype=torch.long, device=x_t.device)
+            out = self.model(x_t, t, cond)
+            x_t = a * x_t + b * out
+            if sigma > 0:
+                x_t = x_t + sigma * torch.randn_like(x_t)
+                assert torch.isnan(x_t).int().sum() == 0, "nan in tensor."
         x_0 = x_t
         return x_0
 
@@ -0,0 +1,59 @@
+import torch
+
+from Binarization.schedule.dpm_solver_pytorch import NoiseScheduleVP, DPM_Solver, dynamic_thresholding, expand_dims
+
+
+class ProgressiveDistillation:
+    """
+    One round of progressive distillation (Salimans & Ho, 2022) on the DPM-Solver++ time grid.
+
+    The student makes one first order DPM-Solver++ step (singlestep, order 1, time_uniform) where the
+    teacher makes two: for a step t -> t_next of the `student_steps` grid, the teacher goes through the
+    midpoint of the 2 * `student_steps` grid, and the student is trained to predict the x0 that brings
+    x_t to the same x_t_next in a single step. A student of this round is the teacher of the next one,
+    and is sampled at test time with SolverPlan(betas, student_steps).
+    """
+
+    def __init__(self, betas, student_steps, thresholding_method='exact'):
+        self.noise_schedule = NoiseScheduleVP(schedule='discrete', betas=betas)
+        self.student_steps = student_steps
+        self.thresholding_method = thresholding_method
+        solver = DPM_Solver(None, self.noise_schedule, algorithm_type="dpmsolver++")
+        #THE STUDENT GRID IS EVERY OTHER POINT OF THE TEACHER GRID
+        self.timesteps = solver.get_time_steps(skip_type='time_uniform', t_T=self.noise_schedule.T,
+                                               t_0=1. / self.noise_schedule.total_N, N=2 * student_steps, device='cpu')
+
+    def model_input_time(self, t):
+        return (t - 1. / self.noise_schedule.total_N) * 1000.
+
+    def step(self, x0, x_s, s, t):
+        #FIRST ORDER DPM-Solver++ STEP s -> t WITH THE DATA PREDICTION x0
+        ns = self.noise_schedule
+        h = ns.marginal_lambda(t) - ns.marginal_lambda(s)
+        sigma_s, sigma_t, alpha_t = ns.marginal_std(s), ns.marginal_std(t), ns.marginal_alpha(t)
+        dims = x_s.dim()
+        return expand_dims(sigma_t / sigma_s, dims) * x_s - expand_dims(alpha_t * torch.expm1(-h), dims) * x0
+
+    def teacher_x0(self, teacher, x, t, cond):
+        x0 = teacher(x, self.model_input_time(t), cond)
+        return dynamic_thresholding(x0, method=self.thresholding_method)
+
+    def training_pair(self, teacher, x0, cond):
+        """
+        Noise the residuals `x0` at random steps of the student grid and run the two teacher steps.
+        Returns (x_t, t_input, target): the student is trained to map student(x_t, t_input, cond) to target.
+        """
+        timesteps = self.timesteps.to(x0.device)
+        index = torch.randint(0, self.student_steps, (x0.shape[0],), device=x0.device)
+        s, mid, t = timesteps[2 * index], timesteps[2 * index + 1], timesteps[2 * index + 2]
+        ns = self.noise_schedule
+        dims = x0.dim()
+        x_s = expand_dims(ns.marginal_alpha(s), dims) * x0 + expand_dims(ns.marginal_std(s), dims) * torch.randn_like(x0)
+        with torch.no_grad():
+            x_mid = self.step(self.teacher_x0(teacher, x_s, s, cond), x_s, s, mid)
+            x_t = self.step(self.teacher_x0(teacher, x_mid, mid, cond), x_mid, mid, t)
+        #x0 OF A SINGLE STEP s -> t THAT REACHES x_t
+        h = ns.marginal_lambda(t) - ns.marginal_lambda(s)
+        target = (x_t - expand_dims(ns.marginal_std(t) / ns.marginal_std(s), dims) * x_s) \
+            / expand_dims(-ns.marginal_alpha(t) * torch.expm1(-h), dims)
+        return x_s, self.model_input_time(s), target
@@ -297,24 +297,16 @@ def model_wrapper(
             return output
         elif model_type == "x_start":
             alpha_t, sigma_t = noise_schedule.marginal_alpha(t_continuous), noise_schedule.marginal_std(t_continuous)
-
-            num_images = x.shape[0]
-            if num_images>1:
-                for i in range(num_images):
-                    if i==0:
-                        result = (x[i] -  torch.unsqueeze(output[i],0) * alpha_t[i] ) / torch.unsqueeze(sigma_t[i],0)
-                    else:
-                        temp_result = (x[i] -  torch.unsqueeze(output[i],0) * alpha_t[i] ) / torch.unsqueeze(sigma_t[i],0)
-                        result = torch.cat((result, temp_result),dim=0)
-                return result 
-            else:
-                return (x -  output * alpha_t ) / sigma_t
+            dims = x.dim()
+            return (x - expand_dims(alpha_t, dims) * output) / expand_dims(sigma_t, dims)
         elif model_type == "v":
             alpha_t, sigma_t = noise_schedule.marginal_alpha(t_continuous), noise_schedule.marginal_std(t_continuous)
-            return alpha_t * output + sigma_t * x
+            dims = x.dim()
+            return expand_dims(alpha_t, dims) * output + expand_dims(sigma_t, dims) * x
         elif model_type == "score":
             sigma_t = noise_schedule.marginal_std(t_continuous)
-            return -sigma_t * output
+            dims = x.dim()
+            return -expand_dims(sigma_t, dims) * output
 
     def cond_grad_fn(x, t_input):
         """
@@ -363,6 +355,7 @@ class DPM_Solver:
         correcting_xt_fn=None,
         thresholding_max_val=1.,
         dynamic_thresholding_ratio=0.995,
+        thresholding_method='exact',
     ):
         """Construct a DPM-Solver. 
 
@@ -415,6 +408,7 @@ class DPM_Solver:
                 Valid only when use `dpmsolver++` and `correcting_x0_fn="dynamic_thresholding"`.
             dynamic_thresholding_ratio: A `float`. The ratio for dynamic thresholding (see Imagen[1] for details).
                 Valid only when use `dpmsolver++` and `correcting_x0_fn="dynamic_thresholding"`.
+            thresholding_method: A `str`. 'exact' or 'approx' quantile for dynamic thresholding (see `dynamic_thresholding`).
 
         [1] Chitwan Saharia, William Chan, Saurabh Saxena, Lala Li, Jay Whang, Emily Denton, Seyed Kamyar Seyed Ghasemipour,
             Burcu Karagol Ayan, S Sara Mahdavi, Rapha Gontijo Lopes, et al. Photorealistic text-to-image diffusion models
@@ -431,22 +425,14 @@ class DPM_Solver:
         self.correcting_xt_fn = correcting_xt_fn
         self.dynamic_thresholding_ratio = dynamic_thresholding_ratio
         self.thresholding_max_val = thresholding_max_val
+        self.thresholding_method = thresholding_method
 
     def dynamic_thresholding_fn(self, x0, t):
         """
         The dynamic thresholding method. 
         """
-        dims = x0.dim()
-        p = self.dynamic_thresholding_ratio
-        #print(torch.abs(x0).reshape((x0.shape[0], -1)).shape)
-        if(torch.abs(x0).reshape((x0.shape[0], -1)).shape[1]<16000000):
-            s = torch.quantile(torch.abs(x0).reshape((x0.shape[0], -1)), p, dim=1)
-        else:
-            #print(torch.abs(x0).reshape((x0.shape[0], -1))[:,0:16000000].shape)
-            s = torch.quantile(torch.abs(x0).reshape((x0.shape[0], -1))[:,0:16000000], p, dim=1)
-        s = expand_dims(torch.maximum(s, self.thresholding_max_val * torch.ones_like(s).to(s.device)), dims)
-        x0 = torch.clamp(x0, -s, s) / s
-        return x0
+        return dynamic_thresholding(x0, self.dynamic_thresholding_ratio, self.thresholding_max_val,
+                                    self.thresholding_method)
 
     def noise_prediction_fn(self, x, t):
         """
@@ -551,7 +537,7 @@ class DPM_Solver:
                 K = steps // 2 + 1
                 orders = [2,] * (K - 1) + [1]
         elif order == 1:
-            K = 1
+            K = steps
             orders = [1,] * steps
         else:
             raise ValueError("'order' must be '1' or '2' or '3'.")
@@ -977,7 +963,7 @@ class DPM_Solver:
         else:
             raise ValueError("Solver order must be 1 or 2 or 3, got {}".format(order))
 
-    def dpm_solver_adaptive(self, x, order, t_T, t_0, h_init=0.05, atol=0.0078, rtol=0.05, theta=0.9, t_err=1e-5, solver_type='dpmsolver'):
+    def dpm_solver_adaptive(self, x, order, t_T, t_0, h_init=0.05, atol=0.0078, rtol=0.05, theta=0.9, t_err=1e-5, solver_type='dpmsolver', max_nfe=None):
         """
         The adaptive step size solver based on singlestep DPM-Solver.
 
@@ -994,8 +980,11 @@ class DPM_Solver:
                 current time and `t_0` is less than `t_err`. The default setting is 1e-5.
             solver_type: either 'dpmsolver' or 'taylor'. The type for the high-order solvers.
                 The type slightly impacts the performance. We recommend to use 'dpmsolver' type.
+            max_nfe: A `int` or None. The budget of model evaluations. When the next trial step would leave less than
+                `order` evaluations, the solver makes a last step to `t_0` (always accepted). Must be >= `order`.
         Returns:
             x_0: A pytorch tensor. The approximated solution at time `t_0`.
+            The number of model evaluations used is stored in `self.nfe`.
 
         [1] A. Jolicoeur-Martineau, K. Li, R. Piché-Taillefer, T. Kachman, and I. Mitliagkas, "Gotta go fast when generating data with score-based models," arXiv preprint arXiv:2105.14080, 2021.
         """
@@ -1017,20 +1006,25 @@ class DPM_Solver:
         else:
             raise ValueError("For adaptive step size solver, order must be 2 or 3, got {}".format(order))
         while torch.abs((s - t_0)).mean() > t_err:
+            last = max_nfe is not None and nfe + 2 * order > max_nfe
+            if last:
+                h = lambda_0 - lambda_s
             t = ns.inverse_lambda(lambda_s + h)
             x_lower, lower_noise_kwargs = lower_update(x, s, t)
             x_higher = higher_update(x, s, t, **lower_noise_kwargs)
             delta = torch.max(torch.ones_like(x).to(x) * atol, rtol * torch.max(torch.abs(x_lower), torch.abs(x_prev)))
             norm_fn = lambda v: torch.sqrt(torch.square(v.reshape((v.shape[0], -1))).mean(dim=-1, keepdim=True))
             E = norm_fn((x_higher - x_lower) / delta).max()
-            if torch.all(E <= 1.):
+            if torch.all(E <= 1.) or last:
                 x = x_higher
                 s = t
                 x_prev = x_lower
                 lambda_s = ns.marginal_lambda(s)
             h = torch.min(theta * h * torch.float_power(E, -1. / order).float(), lambda_0 - lambda_s)
             nfe += order
-        print('adaptive solver nfe', nfe)
+            if last:
+                break
+        self.nfe = nfe
         return x
 
     def add_noise(self, x, t, noise=None):
@@ -1274,6 +1268,44 @@ class DPM_Solver:
 # other utility functions
 #############################################################
 
+def dynamic_thresholding(x0, ratio=0.995, max_val=1., method='exact', max_samples=2 ** 20, chunk_elements=2 ** 26):
+    """
+    The dynamic thresholding method of Imagen: clamp each sample of `x0` to [-s, s] and divide by s,
+    where s is the `ratio` quantile of |x0| (at least `max_val`).
+
+    The samples whose quantile is not above `max_val` (the usual case for a model predicting the clean
+    image) are found by counting, without sorting. For the other ones:
+        - method 'exact' gives the torch.quantile (linear interpolation) value from the top (1 - ratio)
+          elements, for any sample size, working on at most about `chunk_elements` elements at a time;
+        - method 'approx' computes the quantile on `max_samples` evenly strided elements of each sample.
+    """
+    dims = x0.dim()
+    a = torch.abs(x0).reshape((x0.shape[0], -1))
+    n = a.shape[1]
+    pos = ratio * (n - 1)
+    lo, hi = int(math.floor(pos)), int(math.ceil(pos))
+    #THE QUANTILE IS <= max_val IFF AT MOST n - 1 - hi ELEMENTS ARE ABOVE max_val
+    s = torch.full((a.shape[0],), max_val, dtype=a.dtype, device=a.device)
+    rows = torch.nonzero((a > max_val).sum(dim=1) > n - 1 - hi).flatten()
+    if len(rows) > 0:
+        if method == 'exact':
+            step = max(1, chunk_elements // n)
+            for i in range(0, len(rows), step):
+                #THE n - lo LARGEST ELEMENTS: v_lo IS THEIR MINIMUM, v_hi THE NEXT ONE
+                top = torch.topk(a[rows[i:i + step]], n - lo, dim=1, sorted=False).values
+                v_lo = torch.min(top, dim=1).values
+                v_hi = v_lo if hi == lo else torch.kthvalue(top, 2, dim=1).values
+                s[rows[i:i + step]] = torch.maximum(v_lo + (pos - lo) * (v_hi - v_lo), s[rows[i:i + step]])
+        elif method == 'approx':
+            stride = max(1, math.ceil(n / max_samples))
+            s[rows] = torch.maximum(torch.quantile(a[rows, ::stride], ratio, dim=1), s[rows])
+        else:
+            raise ValueError("Unsupported thresholding method {}, need to be 'exact' or 'approx'".format(method))
+    s = expand_dims(s, dims)
+    x0 = torch.clamp(x0, -s, s) / s
+    return x0
+
+
 def interpolate_fn(x, xp, yp):
     """
     A piecewise linear function y = f(x), using xp and yp as keypoints.
@@ -0,0 +1,473 @@
+import json
+import math
+
+import torch
+
+from Binarization.schedule.dpm_solver_pytorch import NoiseScheduleVP, DPM_Solver, model_wrapper, dynamic_thresholding
+
+
+def warm_start(noise_schedule, t_start, noise, residual=None):
+    """
+    State at time `t_start` of the residual `residual` (zero if None): alpha * residual + sigma * noise.
+    At t_start = T the noise itself, as in the full sampling.
+    """
+    if t_start >= noise_schedule.T:
+        return noise
+    t = torch.full((1,), t_start, dtype=noise.dtype, device=noise.device)
+    x = noise_schedule.marginal_std(t) * noise
+    return x if residual is None else x + noise_schedule.marginal_alpha(t) * residual
+
+
+def lin(*terms):
+    """
+    Linear combination of registers: each term is (coef, item), where item is a register index
+    or a combination returned by lin. Returns the combination as a {register: coef} dict.
+    """
+    out = {}
+    for coef, item in terms:
+        for reg, c in (item.items() if isinstance(item, dict) else [(item, 1.)]):
+            out[reg] = out.get(reg, 0.) + coef * c
+    return out
+
+
+class SolverPlan:
+    """
+    DPM-Solver++ sampling compiled once for a fixed (betas, steps, order, skip_type, method).
+    `skip_type` is a DPM_Solver time grid type or an explicit list of times from t_start down to t_0
+    (e.g. searched by utils/search_schedule.py), in which case `steps` and `t_start` are taken from the list.
+    `method` is 'singlestep' or 'multistep' DPM-Solver++, or 'unipc' (multistep UniPC-bh2 predictor-corrector,
+    same NFE as multistep: the corrector reuses the model evaluation needed by the next step).
+
+    The time grid, the alpha/sigma/lambda values and the update coefficients are computed when the
+    plan is built, and the sampler is flattened in a list of register operations:
+
+        ('eval', src, t_input, dst)     regs[dst] = thresholding(model(regs[src], t_input, cond))
+        ('combine', dst, {reg: coef})   regs[dst] = sum(coef * regs[reg])
+
+    so sampling a batch only runs the denoiser and a few scaled tensor additions, and the same plan
+    is reused for every page, batch and validation step. Registers are released after their last use.
+    The model is a data prediction (x_start) model called as model(x, t_input, cond); its output is
+    used directly as x0, instead of going through the noise prediction and back.
+
+    Example:
+        >>> plan = SolverPlan(schedule.get_betas(), steps=10)
+        >>> residual = plan.sample(network.denoiser, noisy_image, init_predict)
+    """
+
+    def __init__(self, betas, steps, order=1, skip_type='time_uniform', method='singlestep', lower_order_final=True,
+                 thresholding=True, dynamic_thresholding_ratio=0.995, thresholding_max_val=1., thresholding_method='exact',
+                 t_start=None):
+        self.noise_schedule = NoiseScheduleVP(schedule='discrete', betas=betas)
+        if not isinstance(skip_type, str):
+            skip_type = [float(t) for t in skip_type]
+            steps, t_start = len(skip_type) - 1, skip_type[0]
+        self.steps = steps
+        self.order = order
+        self.skip_type = skip_type
+        self.method = method
+        self.thresholding = thresholding
+        self.dynamic_thresholding_ratio = dynamic_thresholding_ratio
+        self.thresholding_max_val = thresholding_max_val
+        self.thresholding_method = thresholding_method
+        self.ops = []
+        self.n_regs = 1
+        self.eval_times = []
+        #TIME GRID OF DPM_Solver.sample
+        self.solver = DPM_Solver(None, self.noise_schedule, algorithm_type="dpmsolver++")
+        #TRUNCATED START: THE GRID GOES FROM t_start (T IF None) TO t_0, SEE initial_state
+        self.t_T = self.noise_schedule.T if t_start is None else t_start
+        self.t_0 = 1. / self.noise_schedule.total_N
+        assert self.t_0 < self.t_T <= self.noise_schedule.T, "t_start must be in (1 / TIMESTEPS, 1]"
+        if isinstance(skip_type, list):
+            assert abs(skip_type[-1] - self.t_0) < 1e-6 and all(s > t for s, t in zip(skip_type, skip_type[1:])), \
+                "The time grid must decrease from t_start to 1 / TIMESTEPS"
+        if method == 'singlestep':
+            self.output = self.build_singlestep()
+        elif method == 'multistep':
+            self.output = self.build_multistep(lower_order_final)
+        elif method == 'unipc':
+            self.output = self.build_unipc(lower_order_final)
+        else:
+            raise ValueError("Unsupported method {}, need to be 'singlestep', 'multistep' or 'unipc'".format(method))
+        self.free = self.liveness()
+
+    @property
+    def nfe(self):
+        return len(self.eval_times)
+
+    # ------------------------------------------------------------------
+    # PLAN CONSTRUCTION
+    # ------------------------------------------------------------------
+
+    def coeffs(self, t):
+        #(lambda, alpha, sigma) OF THE CONTINUOUS TIME t
+        ns = self.noise_schedule
+        t = t.reshape((1,))
+        return ns.marginal_lambda(t), torch.exp(ns.marginal_log_mean_coeff(t)), ns.marginal_std(t)
+
+    def time_steps(self, N):
+        if isinstance(self.skip_type, str):
+            return self.solver.get_time_steps(skip_type=self.skip_type, t_T=self.t_T, t_0=self.t_0, N=N, device='cpu')
+        return torch.tensor(self.skip_type)
+
+    def new_reg(self):
+        self.n_regs += 1
+        return self.n_regs - 1
+
+    def eval(self, src, t):
+        t_input = (t.reshape((1,)) - 1. / self.noise_schedule.total_N) * 1000.
+        dst = self.new_reg()
+        self.ops.append(('eval', src, float(t_input), dst))
+        self.eval_times.append(float(t_input))
+        return dst
+
+    def combine(self, terms):
+        dst = self.new_reg()
+        self.ops.append(('combine', dst, {reg: float(coef) for reg, coef in terms.items()}))
+        return dst
+
+    def build_singlestep(self):
+        if isinstance(self.skip_type, str):
+            timesteps_outer, orders = self.solver.get_orders_and_timesteps_for_singlestep_solver(
+                steps=self.steps, order=self.order, skip_type=self.skip_type, t_T=self.t_T, t_0=self.t_0, device='cpu')
+        else:
+            #EXPLICIT GRID: ONE STEP OF ORDER self.order PER INTERVAL, INNER POINTS UNIFORM IN logSNR
+            timesteps_outer, orders = self.time_steps(self.steps), [self.order] * self.steps
+        inner_skip_type = self.skip_type if isinstance(self.skip_type, str) else 'logSNR'
+        x = 0
+        for step, order in enumerate(orders):
+            s, t = timesteps_outer[step], timesteps_outer[step + 1]
+            timesteps_inner = self.solver.get_time_steps(skip_type=inner_skip_type, t_T=s.item(), t_0=t.item(), N=order,
+                                                         device='cpu')
+            lambda_inner = self.noise_schedule.marginal_lambda(timesteps_inner)
+            h = lambda_inner[-1] - lambda_inner[0]
+            r1 = None if order <= 1 else (lambda_inner[1] - lambda_inner[0]) / h
+            r2 = None if order <= 2 else (lambda_inner[2] - lambda_inner[0]) / h
+            x = self.singlestep_update(x, s, t, order, r1, r2)
+        return x
+
+    def singlestep_update(self, x, s, t, order, r1=None, r2=None):
+        ns = self.noise_schedule
+        lambda_s, _, sigma_s = self.coeffs(s)
+        lambda_t, alpha_t, sigma_t = self.coeffs(t)
+        h = lambda_t - lambda_s
+        phi_1 = torch.expm1(-h)
+        model_s = self.eval(x, s)
+        if order == 1:
+            return self.combine(lin((sigma_t / sigma_s, x), (-alpha_t * phi_1, model_s)))
+        if order == 2:
+            r1 = 0.5 if r1 is None else r1
+            s1 = ns.inverse_lambda(lambda_s + r1 * h)
+            _, alpha_s1, sigma_s1 = self.coeffs(s1)
+            phi_11 = torch.expm1(-r1 * h)
+            x_s1 = self.combine(lin((sigma_s1 / sigma_s, x), (-alpha_s1 * phi_11, model_s)))
+            model_s1 = self.eval(x_s1, s1)
+            return self.combine(lin((sigma_t / sigma_s, x), (-alpha_t * phi_1, model_s),
+                                    (-(0.5 / r1) * alpha_t * phi_1, lin((1., model_s1), (-1., model_s)))))
+        if order == 3:
+            r1 = 1. / 3. if r1 is None else r1
+            r2 = 2. / 3. if r2 is None else r2
+            s1 = ns.inverse_lambda(lambda_s + r1 * h)
+            s2 = ns.inverse_lambda(lambda_s + r2 * h)
+            _, alpha_s1, sigma_s1 = self.coeffs(s1)
+            _, alpha_s2, sigma_s2 = self.coeffs(s2)
+            phi_11 = torch.expm1(-r1 * h)
+            phi_12 = torch.expm1(-r2 * h)
+            phi_22 = torch.expm1(-r2 * h) / (r2 * h) + 1.
+            phi_2 = phi_1 / h + 1.
+            x_s1 = self.combine(lin((sigma_s1 / sigma_s, x), (-alpha_s1 * phi_11, model_s)))
+            model_s1 = self.eval(x_s1, s1)
+            x_s2 = self.combine(lin((sigma_s2 / sigma_s, x), (-alpha_s2 * phi_12, model_s),
+                                    (r2 / r1 * alpha_s2 * phi_22, lin((1., model_s1), (-1., model_s)))))
+            model_s2 = self.eval(x_s2, s2)
+            return self.combine(lin((sigma_t / sigma_s, x), (-alpha_t * phi_1, model_s),
+                                    ((1. / r2) * alpha_t * phi_2, lin((1., model_s2), (-1., model_s)))))
+        raise ValueError("Solver order must be 1 or 2 or 3, got {}".format(order))
+
+    def build_multistep(self, lower_order_final):
+        steps, order = self.steps, self.order
+        assert steps >= order
+        timesteps = self.time_steps(steps)
+        x = 0
+        t = timesteps[0]
+        t_prev_list = [t]
+        model_prev_list = [self.eval(x, t)]
+        for step in range(1, order):
+            t = timesteps[step]
+            x = self.multistep_update(x, model_prev_list, t_prev_list, t, step)
+            t_prev_list.append(t)
+            model_prev_list.append(self.eval(x, t))
+        for step in range(order, steps + 1):
+            t = timesteps[step]
+            if lower_order_final and steps < 10:
+                step_order = min(order, steps + 1 - step)
+            else:
+                step_order = order
+            x = self.multistep_update(x, model_prev_list, t_prev_list, t, step_order)
+            for i in range(order - 1):
+                t_prev_list[i] = t_prev_list[i + 1]
+                model_prev_list[i] = model_prev_list[i + 1]
+            t_prev_list[-1] = t
+            if step < steps:
+                model_prev_list[-1] = self.eval(x, t)
+        return x
+
+    def multistep_update(self, x, model_prev_list, t_prev_list, t, order):
+        lambda_t, alpha_t, sigma_t = self.coeffs(t)
+        lambda_prev_0, _, sigma_prev_0 = self.coeffs(t_prev_list[-1])
+        model_prev_0 = model_prev_list[-1]
+        h = lambda_t - lambda_prev_0
+        phi_1 = torch.expm1(-h)
+        if order == 1:
+            return self.combine(lin((sigma_t / sigma_prev_0, x), (-alpha_t * phi_1, model_prev_0)))
+        if order == 2:
+            lambda_prev_1, _, _ = self.coeffs(t_prev_list[-2])
+            model_prev_1 = model_prev_list[-2]
+            r0 = (lambda_prev_0 - lambda_prev_1) / h
+            D1_0 = lin((1. / r0, model_prev_0), (-1. / r0, model_prev_1))
+            return self.combine(lin((sigma_t / sigma_prev_0, x), (-alpha_t * phi_1, model_prev_0),
+                                    (-0.5 * alpha_t * phi_1, D1_0)))
+        if order == 3:
+            model_prev_2, model_prev_1, model_prev_0 = model_prev_list
+            lambda_prev_2, _, _ = self.coeffs(t_prev_list[0])
+            lambda_prev_1, _, _ = self.coeffs(t_prev_list[1])
+            r0 = (lambda_prev_0 - lambda_prev_1) / h
+            r1 = (lambda_prev_1 - lambda_prev_2) / h
+            D1_0 = lin((1. / r0, model_prev_0), (-1. / r0, model_prev_1))
+            D1_1 = lin((1. / r1, model_prev_1), (-1. / r1, model_prev_2))
+            D1 = lin((1., D1_0), (r0 / (r0 + r1), lin((1., D1_0), (-1., D1_1))))
+            D2 = lin((1. / (r0 + r1), lin((1., D1_0), (-1., D1_1))))
+            phi_2 = phi_1 / h + 1.
+            phi_3 = phi_2 / h - 0.5
+            return self.combine(lin((sigma_t / sigma_prev_0, x), (-alpha_t * phi_1, model_prev_0),
+                                    (alpha_t * phi_2, D1), (-alpha_t * phi_3, D2)))
+        raise ValueError("Solver order must be 1 or 2 or 3, got {}".format(order))
+
+    def build_unipc(self, lower_order_final):
+        steps, order = self.steps, self.order
+        assert steps >= order
+        timesteps = self.time_steps(steps)
+        x = 0
+        t = timesteps[0]
+        t_prev_list = [t]
+        model_prev_list = [self.eval(x, t)]
+        for step in range(1, order):
+            t = timesteps[step]
+            x, model_x = self.unipc_update(x, model_prev_list, t_prev_list, t, step, use_corrector=True)
+            t_prev_list.append(t)
+            model_prev_list.append(model_x)
+        for step in range(order, steps + 1):
+            t = timesteps[step]
+            step_order = min(order, steps + 1 - step) if lower_order_final else order
+            #NO CORRECTOR AFTER THE LAST STEP, IT WOULD COST ONE MORE MODEL EVALUATION
+            x, model_x = self.unipc_update(x, model_prev_list, t_prev_list, t, step_order, use_corrector=step < steps)
+            for i in range(order - 1):
+                t_prev_list[i] = t_prev_list[i + 1]
+                model_prev_list[i] = model_prev_list[i + 1]
+            t_prev_list[-1] = t
+            if step < steps:
+                model_prev_list[-1] = model_x
+        return x
+
+    def unipc_update(self, x, model_prev_list, t_prev_list, t, order, use_corrector):
+        #UniPC WITH B(h) = expm1(-h) (bh2), DATA PREDICTION. SEE Zhao et al., UniPC, 2023
+        if order not in [1, 2, 3]:
+            raise ValueError("Solver order must be 1 or 2 or 3, got {}".format(order))
+        lambda_t, alpha_t, sigma_t = self.coeffs(t)
+        lambda_prev_0, _, sigma_prev_0 = self.coeffs(t_prev_list[-1])
+        model_prev_0 = model_prev_list[-1]
+        h = float(lambda_t - lambda_prev_0)
+        rks, D1s = [], []
+        for i in range(1, order):
+            lambda_prev_i, _, _ = self.coeffs(t_prev_list[-(i + 1)])
+            rk = float(lambda_prev_i - lambda_prev_0) / h
+            rks.append(rk)
+            D1s.append(lin((1. / rk, model_prev_list[-(i + 1)]), (-1. / rk, model_prev_0)))
+        rks.append(1.)
+        rks = torch.tensor(rks, dtype=torch.float64)
+
+        hh = -h
+        h_phi_1 = math.expm1(hh)
+        h_phi_k = h_phi_1 / hh - 1.
+        B_h = math.expm1(hh)
+        factorial_i = 1
+        R, b = [], []
+        for i in range(1, order + 1):
+            R.append(torch.pow(rks, i - 1))
+            b.append(h_phi_k * factorial_i / B_h)
+            factorial_i *= (i + 1)
+            h_phi_k = h_phi_k / hh - 1. / factorial_i
+        R = torch.stack(R)
+        b = torch.tensor(b, dtype=torch.float64)
+
+        alpha_t, sigma_t, sigma_prev_0 = float(alpha_t), float(sigma_t), float(sigma_prev_0)
+        x_t_ = lin((sigma_t / sigma_prev_0, x), (-alpha_t * h_phi_1, model_prev_0))
+        #PREDICTOR
+        if order == 1:
+            rhos_p = []
+        elif order == 2:
+            rhos_p = [0.5]
+        else:
+            rhos_p = torch.linalg.solve(R[:-1, :-1], b[:-1]).tolist()
+        x_t = self.combine(lin((1., x_t_), *((-alpha_t * B_h * rho, D1) for rho, D1 in zip(rhos_p, D1s))))
+        if not use_corrector:
+            return x_t, None
+        #CORRECTOR, WITH THE MODEL EVALUATED AT THE PREDICTED x_t
+        rhos_c = [0.5] if order == 1 else torch.linalg.solve(R, b).tolist()
+        model_t = self.eval(x_t, t)
+        D1_t = lin((1., model_t), (-1., model_prev_0))
+        x_t = self.combine(lin((1., x_t_), *((-alpha_t * B_h * rho, D1) for rho, D1 in zip(rhos_c[:-1], D1s)),
+                               (-alpha_t * B_h * rhos_c[-1], D1_t)))
+        return x_t, model_t
+
+    def liveness(self):
+        #REGISTERS TO RELEASE AFTER EACH OPERATION (AFTER THEIR LAST READ)
+        last_use = {}
+        for i, op in enumerate(self.ops):
+            reads = [op[1]] if op[0] == 'eval' else list(op[2])
+            for reg in reads:
+                last_use[reg] = i
+        free = [[] for _ in self.ops]
+        for reg, i in last_use.items():
+            if reg != self.output:
+                free[i].append(reg)
+        return free
+
+    # ------------------------------------------------------------------
+    # SAMPLING
+    # ------------------------------------------------------------------
+
+    def denoise(self, model, x, t_input, cond):
+        x0 = model(x, torch.full((x.shape[0],), t_input, dtype=x.dtype, device=x.device), cond)
+        if self.thresholding:
+            x0 = dynamic_thresholding(x0, self.dynamic_thresholding_ratio, self.thresholding_max_val,
+                                      self.thresholding_method)
+        return x0
+
+    def initial_state(self, noise, residual=None):
+        return warm_start(self.noise_schedule, self.t_T, noise, residual)
+
+    def sample(self, model, x, cond, patience=0, tolerance=0.):
+        """
+        Sample from the initial state `x` at the first time of the plan (see initial_state), conditioned on `cond`.
+
+        If `patience` > 0, a sample whose binarized estimate (x0 + cond > 0.5) changes in at most a `tolerance`
+        fraction of its pixels for `patience` consecutive model evaluations is retired with its current x0, and
+        the next evaluations run on the remaining samples only. The output keeps the order of `x`.
+        `evals` is the number of model evaluations of the last call (less than `nfe` if every sample was
+        retired early), `tile_evals` the number of (sample, model evaluation) pairs.
+        """
+        regs = [None] * self.n_regs
+        regs[0] = x
+        self.evals = 0
+        self.tile_evals = 0
+        if patience > 0:
+            out = torch.empty_like(x)
+            active = torch.arange(x.shape[0], device=x.device)
+            stable = torch.zeros(x.shape[0], dtype=torch.long, device=x.device)
+            mask = None
+        with torch.no_grad():
+            for op, free in zip(self.ops, self.free):
+                if op[0] == 'eval':
+                    _, src, t_input, dst = op
+                    regs[dst] = self.denoise(model, regs[src], t_input, cond)
+                    self.evals += 1
+                    self.tile_evals += regs[dst].shape[0]
+                else:
+                    _, dst, terms = op
+                    res = None
+                    for reg, coef in terms.items():
+                        res = regs[reg] * coef if res is None else res.add_(regs[reg], alpha=coef)
+                    regs[dst] = res
+                for reg in free:
+                    regs[reg] = None
+                if patience > 0 and op[0] == 'eval':
+                    #STABILITY OF THE BINARIZED ESTIMATE OF EACH ACTIVE SAMPLE
+                    new_mask = (regs[dst] + cond) > 0.5
+                    if mask is not None:
+                        changed = (new_mask != mask).flatten(1).float().mean(dim=1)
+                        stable = torch.where(changed <= tolerance, stable + 1, torch.zeros_like(stable))
+                    mask = new_mask
+                    done = stable >= patience
+                    if bool(done.any()):
+                        #RETIRE THE CONVERGED SAMPLES AND COMPACT THE ACTIVE BATCH
+                        out[active[done]] = regs[dst][done]
+                        keep = ~done
+                        if not bool(keep.any()):
+                            return out
+                        regs = [reg if reg is None else reg[keep] for reg in regs]
+                        cond, active, stable, mask = cond[keep], active[keep], stable[keep], mask[keep]
+        if patience > 0:
+            out[active] = regs[self.output]
+            return out
+        return regs[self.output]
+
+
+class AdaptiveSolver:
+    """
+    Adaptive step size DPM-Solver++ (DPM_Solver.dpm_solver_adaptive): the steps are chosen from the error between
+    the order - 1 and the order updates, with tolerances `atol`/`rtol`, under a budget of `max_nfe` model evaluations.
+    Easy batches need fewer steps. Same interface as SolverPlan, `nfe` (and `evals`) is the number of evaluations
+    of the last batch.
+    """
+
+    def __init__(self, betas, order=2, atol=0.0078, rtol=0.05, max_nfe=None, thresholding_method='exact', t_start=None):
+        if order not in [2, 3]:
+            raise ValueError("For adaptive step size solver, order must be 2 or 3, got {}".format(order))
+        self.noise_schedule = NoiseScheduleVP(schedule='discrete', betas=betas)
+        self.order = order
+        self.atol = atol
+        self.rtol = rtol
+        self.max_nfe = max_nfe
+        self.thresholding_method = thresholding_method
+        self.t_T = self.noise_schedule.T if t_start is None else t_start
+        self.nfe = 0
+        self.evals = 0
+        self.tile_evals = 0
+
+    def initial_state(self, noise, residual=None):
+        return warm_start(self.noise_schedule, self.t_T, noise, residual)
+
+    def sample(self, model, x, cond):
+        model_fn = model_wrapper(model, self.noise_schedule, model_type="x_start", model_kwargs={},
+                                 guidance_type="classifier-free", condition=cond)
+        solver = DPM_Solver(model_fn, self.noise_schedule, algorithm_type="dpmsolver++",
+                            correcting_x0_fn="dynamic_thresholding", thresholding_method=self.thresholding_method)
+        with torch.no_grad():
+            x = solver.dpm_solver_adaptive(x, order=self.order, t_T=self.t_T,
+                                           t_0=1. / self.noise_schedule.total_N, atol=self.atol, rtol=self.rtol,
+                                           max_nfe=self.max_nfe)
+        self.nfe = solver.nfe
+        self.evals = self.nfe
+        self.tile_evals = self.nfe * x.shape[0]
+        return x
+
+
+def save_schedule(path, timesteps, method, order, total_N, metrics=None):
+    """
+    Save a searched time grid (continuous times from t_start down to 1 / total_N) with the solver it was
+    searched for, and its metrics, as a JSON file read by load_schedule (DPM_SCHEDULE_PATH).
+    """
+    with open(path, 'w') as f:
+        json.dump({'timesteps': [float(t) for t in timesteps], 'method': method, 'order': order,
+                   'total_N': total_N, 'metrics': metrics}, f, indent=2)
+
+
+def load_schedule(path, total_N):
+    with open(path) as f:
+        schedule = json.load(f)
+    if schedule['total_N'] != total_N:
+        raise ValueError(f"The schedule {path} was searched for {schedule['total_N']} timesteps, not {total_N}")
+    return schedule
+
+
+def build_solver(betas, steps, method='singlestep', order=1, skip_type='time_uniform', thresholding_method='exact',
+                 atol=0.0078, rtol=0.05, max_nfe=None, t_start=None):
+    """
+    SolverPlan for the fixed step methods, AdaptiveSolver for method 'adaptive' (`steps` is not used).
+    """
+    if method == 'adaptive':
+        return AdaptiveSolver(betas, order=order, atol=atol, rtol=rtol, max_nfe=max_nfe,
+                              thresholding_method=thresholding_method, t_start=t_start)
+    return SolverPlan(betas, steps, order=order, skip_type=skip_type, method=method,
+                      thresholding_method=thresholding_method, t_start=t_start)
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+
+import cv2
+import numpy as np
+import torch
+
+from Binarization.src.pipeline import binarize
+
+
+def checkpoint_identity(path):
+    """
+    Identify a checkpoint file by its absolute path, size and modification time.
+    """
+    path = os.path.abspath(path)
+    if not os.path.exists(path):
+        return [path]
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+class ResultCache:
+    """
+    Content addressed on-disk cache of the binarized pages.
+
+    The key of a page is the sha256 of its pixels and shape, salted with the digest of
+    `settings` (checkpoints and sampler settings), so changing the weights or the sampler
+    invalidates the cached results. Results are stored as PNG files in `path`; when the total
+    size exceeds `max_bytes` the least recently used files are evicted (hits refresh the
+    modification time of the file).
+
+    Example:
+        >>> cache = ResultCache('./cache', 1 << 30, settings)
+        >>> key = cache.key(img)
+        >>> final_imgs = cache.get(key)
+        >>> if final_imgs is None:
+        >>>     final_imgs = restore(img)
+        >>>     cache.put(key, final_imgs)
+    """
+
+    def __init__(self, path, max_bytes, settings):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.salt = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).digest()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.name.endswith('.png'))
+
+    def key(self, img):
+        pixels = np.ascontiguousarray(img.detach().cpu().numpy())
+        digest = hashlib.sha256(self.salt)
+        digest.update(str((pixels.shape, pixels.dtype.str)).encode())
+        digest.update(pixels.data)
+        return digest.hexdigest()
+
+    def file(self, key):
+        return os.path.join(self.path, f"{key}.png")
+
+    def get(self, key):
+        """
+        Return the cached binarized page (1, 1, H, W) with values 0 and 1, or None.
+        """
+        path = self.file(key)
+        result = cv2.imread(path, cv2.IMREAD_GRAYSCALE) if os.path.exists(path) else None
+        with self.lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return torch.from_numpy(result > 127).float()[None, None]
+
+    def put(self, key, final_imgs):
+        self.put_binary(key, binarize(final_imgs))
+
+    def put_binary(self, key, binary):
+        """
+        Store a page already binarized by binarize (uint8 (H, W) array with values 0 and 255).
+        """
+        path = self.file(key)
+        ok, data = cv2.imencode('.png', binary)
+        if not ok:
+            return
+        #UNIQUE PER PROCESS AND THREAD (FORKED WORKERS SHARE THE THREAD IDENT OF THE PARENT)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data.tobytes())
+        with self.lock:
+            if os.path.exists(path):
+                self.size -= os.path.getsize(path)
+            os.replace(tmp, path)
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        #REMOVE THE LEAST RECENTLY USED RESULTS UNTIL THE CACHE IS BACK UNDER max_bytes
+        entries = sorted((entry for entry in os.scandir(self.path) if entry.name.endswith('.png')),
+                         key=lambda entry: entry.stat().st_mtime_ns)
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except OSError:
+                continue
+
+    def counts(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def add_counts(self, hits=0, misses=0):
+        #MERGE THE LOOKUPS MADE BY ANOTHER PROCESS
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+    def summary(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size_mb': self.size / 2 ** 20}
@@ -0,0 +1,55 @@
+import os
+
+import torch
+import torch.nn as nn
+
+
+def enable_compile_cache(cache_dir):
+    """
+    Persist the compiled kernels and graphs of torch.compile in `cache_dir`, so that the
+    compilation is paid once per machine and reused by the next runs.
+    Must be called before the first compilation.
+    """
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = cache_dir
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+    if hasattr(inductor_config, 'autotune_local_cache'):
+        inductor_config.autotune_local_cache = True
+
+
+def bucket_size(batch):
+    """
+    Smallest power of two >= batch.
+    """
+    return 1 << max(batch - 1, 0).bit_length()
+
+
+class CompiledModule(nn.Module):
+    """
+    torch.compile wrapper with batch size bucketing.
+
+    The module is compiled with static shapes; the batch dimension of the tensor arguments is
+    zero padded to the next power of two, so the varying batches of the tile packer and of the
+    blank/cascade selections hit a handful of compiled graphs instead of recompiling for each
+    batch size. The outputs are cropped back to the real batch. The spatial size is expected
+    to be fixed (tiles or IMAGE_SIZE).
+
+    The wrapped module is kept as `module`, so `CompiledModule(net).module.state_dict()` is
+    the state dict of `net`.
+    """
+
+    def __init__(self, module, mode=None):
+        super().__init__()
+        self.module = module
+        self.compiled = torch.compile(module, dynamic=False, mode=mode)
+
+    def forward(self, *args):
+        batch = next(arg.shape[0] for arg in args if torch.is_tensor(arg))
+        bucket = bucket_size(batch)
+        if bucket != batch:
+            args = [torch.cat([arg, arg.new_zeros((bucket - batch, *arg.shape[1:]))])
+                    if torch.is_tensor(arg) and arg.dim() > 0 and arg.shape[0] == batch else arg
+                    for arg in args]
+        return self.compiled(*args)[:batch]
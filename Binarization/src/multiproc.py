@@ -0,0 +1,154 @@
+import os
+import queue
+import time
+
+import cv2
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+from Binarization.data.docdata import read_image
+from Binarization.src.pipeline import list_images, binarize
+from Binarization.src.tiling import TilePacker
+
+
+def worker_cores(rank, threads_per_process):
+    """
+    Cores assigned to the worker `rank` when pinning: consecutive blocks of `threads_per_process`
+    cores of the ones available to the main process (None if there are not enough cores).
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    start = rank * threads_per_process
+    if start + threads_per_process > len(cores):
+        return None
+    return cores[start:start + threads_per_process]
+
+
+class MultiprocessInference:
+    """
+    Multi-process CPU folder inference.
+
+    Pages of `input_path` are distributed to `num_processes` forked workers through a task queue;
+    each worker uses `threads_per_process` torch threads (optionally pinned to its own cores) and
+    restores its pages with the networks of `tester`, whose weights are moved to shared memory
+    before forking so they are stored once. The binarized pages are sent back to the main process,
+    which writes them in input order and keeps a single progress bar, tile and cache statistics.
+    Workers only read the result cache; the main process stores the new results, so a single
+    process writes the cache files and tracks the cache size.
+    """
+
+    def __init__(self, tester, input_path, output_path, num_processes, threads_per_process=1, pin_cores=False,
+                 batch_size=16):
+        self.tester = tester
+        self.input_path = input_path
+        self.output_path = output_path
+        self.num_processes = num_processes
+        self.threads_per_process = threads_per_process
+        self.pin_cores = pin_cores
+        self.batch_size = batch_size
+        self.logger = tester.logger
+
+    def worker(self, rank, tasks, results):
+        torch.set_num_threads(self.threads_per_process)
+        if self.pin_cores and hasattr(os, 'sched_setaffinity'):
+            cores = worker_cores(rank, self.threads_per_process)
+            if cores is not None:
+                os.sched_setaffinity(0, cores)
+        torch.manual_seed(rank)
+        tester = self.tester
+        with torch.no_grad():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                index, name = task
+                before = self.counters()
+                key, result, error = None, None, None
+                try:
+                    img = read_image(os.path.join(self.input_path, name))
+                    if img is None:
+                        error = "not a readable image"
+                    else:
+                        key, final_imgs = tester.lookup(img)
+                        if final_imgs is None:
+                            packer = TilePacker(self.batch_size, tester.tile_size)
+                            packer.add_page(name, img)
+                            [(_, final_imgs)] = tester.drain(packer, flush=True)
+                        else:
+                            #ALREADY CACHED
+                            key = None
+                        result = binarize(final_imgs)
+                except Exception as e:
+                    error = repr(e)
+                stats = [{counter: value - start[counter] for counter, value in current.items()}
+                         for start, current in zip(before, self.counters())]
+                results.put((index, name, key, result, stats, error))
+
+    def counters(self):
+        #TILE, DENOISER AND CACHE COUNTERS OF THIS PROCESS
+        cache = self.tester.cache
+        return [dict(self.tester.tile_stats), dict(self.tester.nfe_stats), cache.counts() if cache is not None else {}]
+
+    def output_file(self, name):
+        name_str, _ = os.path.splitext(name)
+        return os.path.join(self.output_path, f"{name_str}.png")
+
+    def run(self):
+        names = list_images(self.input_path)
+        ctx = mp.get_context('fork')
+        tasks = ctx.Queue()
+        results = ctx.Queue()
+
+        #SHARE THE WEIGHTS WITH THE WORKERS INSTEAD OF COPYING THEM
+        self.tester.network.share_memory()
+        for task in enumerate(names):
+            tasks.put(task)
+        for _ in range(self.num_processes):
+            tasks.put(None)
+
+        start = time.time()
+        workers = [ctx.Process(target=self.worker, args=(rank, tasks, results), daemon=True)
+                   for rank in range(self.num_processes)]
+        for process in workers:
+            process.start()
+
+        #REORDER BUFFER: WRITE THE PAGES IN INPUT ORDER
+        done = {}
+        next_index = 0
+        written = 0
+        tq = tqdm(total=len(names))
+        for _ in range(len(names)):
+            while True:
+                try:
+                    index, name, key, result, stats, error = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if any(process.exitcode not in (None, 0) for process in workers):
+                        raise RuntimeError("An inference worker died unexpectedly")
+            for current, delta in zip([self.tester.tile_stats, self.tester.nfe_stats], stats):
+                for counter, value in delta.items():
+                    current[counter] += value
+            if self.tester.cache is not None:
+                self.tester.cache.add_counts(**stats[2])
+                if key is not None and result is not None:
+                    self.tester.cache.put_binary(key, result)
+            done[index] = (name, result, error)
+            while next_index in done:
+                name, result, error = done.pop(next_index)
+                if error is not None:
+                    self.logger.warning(f"Skipping {name}: {error}")
+                elif not cv2.imwrite(self.output_file(name), result):
+                    raise IOError("Could not write {}".format(self.output_file(name)))
+                else:
+                    written += 1
+                next_index += 1
+                tq.update(1)
+        tq.close()
+        for process in workers:
+            process.join()
+
+        elapsed = time.time() - start
+        skipped = len(names) - written
+        self.logger.info(f"Processed {written} pages in {elapsed:.2f}s ({written / max(elapsed, 1e-9):.2f} pages/s) "
+                         f"with {self.num_processes} processes x {self.threads_per_process} threads"
+                         + (f", {skipped} skipped" if skipped else ""))
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+INIT_PREDICTOR_FILE = 'init_predictor.onnx'
+DENOISER_FILE = 'denoiser.onnx'
+
+
+def export_onnx(module, inputs, path, input_names, opset=17):
+    """
+    Export `module` called on the tuple `inputs` to the ONNX file `path`, with a dynamic batch
+    dimension for every input and for the output. The spatial size is the one of `inputs`
+    (the kernels of the Local_Base TLSC pooling depend on it).
+    """
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + ['output']}
+    module.eval()
+    with torch.no_grad():
+        torch.onnx.export(module, inputs, path, input_names=input_names, output_names=['output'],
+                          dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False)
+
+
+def export_nafdpm(network, output_path, channels_x=1, channels_y=1, size=256, opset=17):
+    """
+    Export the initial predictor and the denoiser (time input included) of a NAFDPM network
+    to `output_path`/init_predictor.onnx and `output_path`/denoiser.onnx for `size` x `size` inputs.
+    Works for the plain (NAFNet/ConditionalNAFNet) and the Local_Base (TLSC) variants.
+    """
+    os.makedirs(output_path, exist_ok=True)
+    device = next(network.parameters()).device
+    img = torch.rand(2, channels_x, size, size, device=device)
+    x = torch.randn(2, channels_y, size, size, device=device)
+    time = torch.tensor([10., 500.], device=device)
+    export_onnx(network.init_predictor, (img,), os.path.join(output_path, INIT_PREDICTOR_FILE), ['img'], opset)
+    export_onnx(network.denoiser, (x, time, x.clone()), os.path.join(output_path, DENOISER_FILE),
+                ['inp', 'time', 'cond'], opset)
+
+
+class OrtModule(nn.Module):
+    """
+    ONNX Runtime backend with the calling convention of the exported PyTorch module:
+    takes and returns torch tensors (the output is moved to the device of the first input),
+    so it can replace the initial predictor or the denoiser in the sampler.
+    """
+
+    def __init__(self, path, threads=0, providers=None):
+        super().__init__()
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        if providers is None:
+            providers = [p for p in ('CUDAExecutionProvider', 'CPUExecutionProvider')
+                         if p in ort.get_available_providers()]
+        self.session = ort.InferenceSession(path, options, providers=providers)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def forward(self, *args):
+        device = args[0].device
+        feeds = {name: arg.detach().float().cpu().numpy() if torch.is_tensor(arg) else np.asarray(arg, dtype=np.float32)
+                 for name, arg in zip(self.input_names, args)}
+        output, = self.session.run(None, feeds)
+        return torch.from_numpy(output).to(device)
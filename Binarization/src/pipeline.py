@@ -0,0 +1,114 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from Binarization.data.docdata import read_image
+from Binarization.src.tiling import TilePacker
+
+IMG_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+
+def list_images(path):
+    return sorted(f for f in os.listdir(path) if f.lower().endswith(IMG_EXTENSIONS))
+
+
+def binarize(final_imgs):
+    """
+    Threshold the final image (1, 1, H, W) at 0.5, as a uint8 (H, W) array with values 0 and 255.
+    """
+    return (torch.clamp(final_imgs, 0, 1)[0, 0] > 0.5).numpy().astype(np.uint8) * 255
+
+
+def write_binary(final_imgs, path):
+    if not cv2.imwrite(path, binarize(final_imgs)):
+        raise IOError("Could not write {}".format(path))
+
+
+class InferencePipeline:
+    """
+    Streaming, GT-free folder inference.
+
+    Input pages are decoded by a pool of `decode_workers` threads, at most `prefetch` pages ahead
+    of the model. Tiles of the decoded pages are packed in batches of `batch_size` tiles and
+    restored by `tester` in the calling thread, and the binarized pages are encoded to PNG (and
+    stored in the result cache) by a pool of `encode_workers` threads while the model works on
+    the next batch.
+    """
+
+    def __init__(self, tester, input_path, output_path, batch_size=16, decode_workers=2, encode_workers=2,
+                 prefetch=8):
+        self.tester = tester
+        self.input_path = input_path
+        self.output_path = output_path
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.encode_workers = encode_workers
+        self.prefetch = prefetch
+        self.logger = tester.logger
+
+    def output_file(self, name):
+        name_str, _ = os.path.splitext(name)
+        return os.path.join(self.output_path, f"{name_str}.png")
+
+    def save(self, name, final_imgs, key=None):
+        #RUNS IN THE ENCODER POOL: WRITE THE PAGE, AND STORE IT IN THE RESULT CACHE IF IT WAS A MISS
+        write_binary(final_imgs, self.output_file(name))
+        self.tester.store(key, final_imgs)
+
+    def run(self):
+        names = list_images(self.input_path)
+        packer = TilePacker(self.batch_size, self.tester.tile_size)
+        decoding = deque()
+        encoding = deque()
+        skipped = 0
+        start = time.time()
+        with ThreadPoolExecutor(self.decode_workers) as decoder, ThreadPoolExecutor(self.encode_workers) as encoder:
+            keys = {}
+
+            def encode(finished):
+                for name, final_imgs in finished:
+                    encoding.append(encoder.submit(self.save, name, final_imgs, keys.pop(name, None)))
+                #BOUND THE PAGES WAITING FOR ENCODING
+                while len(encoding) > self.prefetch:
+                    encoding.popleft().result()
+
+            pending = iter(names)
+            for name in pending:
+                decoding.append((name, decoder.submit(read_image, os.path.join(self.input_path, name))))
+                if len(decoding) >= self.prefetch:
+                    break
+
+            tq = tqdm(total=len(names))
+            while decoding:
+                name, future = decoding.popleft()
+                next_name = next(pending, None)
+                if next_name is not None:
+                    decoding.append((next_name, decoder.submit(read_image, os.path.join(self.input_path, next_name))))
+                img = future.result()
+                tq.update(1)
+                if img is None:
+                    self.logger.warning(f"Skipping {name}: not a readable image")
+                    skipped += 1
+                    continue
+                key, final_imgs = self.tester.lookup(img)
+                if final_imgs is not None:
+                    encode([(name, final_imgs)])
+                    continue
+                keys[name] = key
+                packer.add_page(name, img)
+                encode(self.tester.drain(packer))
+            encode(self.tester.drain(packer, flush=True))
+            while encoding:
+                encoding.popleft().result()
+            tq.close()
+
+        elapsed = time.time() - start
+        written = len(names) - skipped
+        self.logger.info(f"Processed {written} pages in {elapsed:.2f}s ({written / max(elapsed, 1e-9):.2f} pages/s)"
+                         + (f", {skipped} skipped" if skipped else ""))
@@ -0,0 +1,89 @@
+import copy
+import os
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, get_default_qat_qconfig_mapping
+from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+from torch.ao.quantization.quantize_fx import prepare_fx, prepare_qat_fx, convert_fx
+
+from Binarization.model import NAFNET, ConditionalNAFNET, local_arch
+
+INIT_PREDICTOR_INT8_FILE = 'init_predictor_int8.pth'
+DENOISER_INT8_FILE = 'denoiser_int8.pth'
+
+
+def custom_config():
+    #LAYERNORM AND TLSC POOLING HAVE SHAPE/DTYPE DEPENDENT CONTROL FLOW: KEEP THEM AS FLOAT LEAVES.
+    #THE TIME EMBEDDING IS A FLOAT LEAF TOO, SO THE (INTEGER) TIMESTEPS ARE NEVER QUANTIZED
+    return PrepareCustomConfig().set_non_traceable_module_classes(
+        [NAFNET.LayerNorm, ConditionalNAFNET.LayerNorm, ConditionalNAFNET.SinusoidalPosEmb, local_arch.AvgPool2d])
+
+
+def example_inputs(kind, channels, size, device='cpu'):
+    """
+    Example inputs used to trace the initial predictor (kind 'init_predictor', channels = CHANNEL_X)
+    or the denoiser (kind 'denoiser', channels = CHANNEL_Y).
+    """
+    if kind == 'init_predictor':
+        return (torch.rand(2, channels, size, size, device=device),)
+    x = torch.randn(2, channels, size, size, device=device)
+    return x, torch.tensor([1., 500.], device=device), torch.rand_like(x)
+
+
+def prepare_ptq(module, inputs, backend='x86'):
+    """
+    Insert the observers for post-training quantization; run calibration data through
+    the returned module, then call convert.
+    """
+    torch.backends.quantized.engine = backend
+    return prepare_fx(copy.deepcopy(module).eval(), get_default_qconfig_mapping(backend), inputs,
+                      prepare_custom_config=custom_config())
+
+
+def prepare_qat(module, inputs, backend='x86'):
+    """
+    Insert the fake quantization modules for quantization-aware training.
+    """
+    torch.backends.quantized.engine = backend
+    return prepare_qat_fx(copy.deepcopy(module).train(), get_default_qat_qconfig_mapping(backend), inputs,
+                          prepare_custom_config=custom_config())
+
+
+def float_state_dict(module):
+    """
+    State dict of `module` without the fake quantization modules inserted by prepare_qat, loadable
+    by the float network (the state dict of a float module is returned unchanged).
+    """
+    return {name: value for name, value in module.state_dict().items()
+            if 'activation_post_process' not in name and 'weight_fake_quant' not in name}
+
+
+def convert(prepared):
+    """
+    Convert a calibrated (or QAT trained) module to int8 kernels (CPU only). `prepared` is not modified.
+    """
+    return convert_fx(copy.deepcopy(prepared).cpu().eval())
+
+
+def save_int8(init_predictor, denoiser, path):
+    os.makedirs(path, exist_ok=True)
+    torch.save(init_predictor.state_dict(), os.path.join(path, INIT_PREDICTOR_INT8_FILE))
+    torch.save(denoiser.state_dict(), os.path.join(path, DENOISER_INT8_FILE))
+
+
+def int8_exists(path):
+    return all(os.path.exists(os.path.join(path, f)) for f in (INIT_PREDICTOR_INT8_FILE, DENOISER_INT8_FILE))
+
+
+def load_int8(network, path, channels_x, channels_y, size, backend='x86'):
+    """
+    Rebuild the int8 initial predictor and denoiser from the float `network` (same architecture)
+    and load the quantized state dicts saved by save_int8. Returns (init_predictor, denoiser).
+    """
+    modules = []
+    for kind, module, channels, file in (('init_predictor', network.init_predictor, channels_x, INIT_PREDICTOR_INT8_FILE),
+                                         ('denoiser', network.denoiser, channels_y, DENOISER_INT8_FILE)):
+        quantized = convert(prepare_ptq(module, example_inputs(kind, channels, size, next(module.parameters()).device), backend))
+        quantized.load_state_dict(torch.load(os.path.join(path, file), map_location='cpu'))
+        modules.append(quantized)
+    return tuple(modules)
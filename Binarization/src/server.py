@@ -0,0 +1,255 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import cv2
+import torch
+
+from Binarization.data.docdata import decode_image
+from Binarization.src.pipeline import binarize
+from Binarization.src.tiling import TilePacker
+
+
+def encode_binary(final_imgs):
+    """
+    Encode the binarized final image (1, 1, H, W) as a grayscale PNG.
+    """
+    _, data = cv2.imencode('.png', binarize(final_imgs))
+    return data.tobytes()
+
+
+class Request:
+    def __init__(self, img, width=None):
+        self.img = img
+        #REQUESTED WIDTH MULTIPLIER (None: CHOSEN BY THE SERVER), AND THE ONE USED
+        self.width = width
+        self.width_used = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.start = time.perf_counter()
+
+
+class ServerStats:
+    """
+    Thread safe counters of the server, exposed by GET /stats.
+    """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_pages = 0
+        self.max_queue_depth = 0
+        self.widths = {}
+
+    def record_batch(self, size, queue_depth):
+        with self.lock:
+            self.batches += 1
+            self.batched_pages += size
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def record_width(self, width, pages):
+        with self.lock:
+            self.widths[width] = self.widths.get(width, 0) + pages
+
+    def record_request(self, latency, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.latencies.append(latency)
+
+    def summary(self, queue_depth):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            summary = {
+                'requests': self.requests,
+                'errors': self.errors,
+                'batches': self.batches,
+                'mean_batch_size': self.batched_pages / self.batches if self.batches else 0.,
+                'queue_depth': queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'pages_per_width': {str(width): pages for width, pages in sorted(self.widths.items())},
+            }
+        if latencies:
+            summary['latency_ms'] = {
+                'mean': 1000. * sum(latencies) / len(latencies),
+                'p50': 1000. * latencies[len(latencies) // 2],
+                'p95': 1000. * latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+                'max': 1000. * latencies[-1],
+            }
+        return summary
+
+
+class InferenceServer:
+    """
+    Long-lived HTTP inference server with dynamic micro-batching.
+
+    The model (held by `tester`, with the checkpoints already loaded) stays in memory. Requests
+    are decoded in the HTTP threads and queued; a single model thread collects up to `max_batch`
+    pages, waiting at most `max_wait` seconds after the first one, packs their tiles in batches
+    of `tile_batch_size` tiles and answers each request with the binarized PNG.
+
+    With slimmable networks (SLIM_WIDTHS), a request can ask for a width multiplier (?width=0.5).
+    The others run at the width of the tester, or, if `degrade_depth` > 0, at the next smaller
+    trained width for every `degrade_depth` pages waiting, so a backlog is served by faster networks.
+
+    Endpoints:
+        POST /binarize   body: encoded page image, answer: binarized PNG (query: optional width)
+        GET  /stats      latency and queue depth statistics (JSON)
+        GET  /health
+    """
+
+    def __init__(self, tester, host='127.0.0.1', port=8080, max_batch=8, max_wait=0.02, tile_batch_size=16,
+                 degrade_depth=0):
+        self.tester = tester
+        self.host = host
+        self.port = port
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.tile_batch_size = tile_batch_size
+        self.degrade_depth = degrade_depth
+        #TRAINED WIDTHS, LARGEST FIRST (ONLY THE TESTER ONE IF THE NETWORKS ARE NOT SLIMMABLE)
+        self.widths = sorted(tester.slim_widths if tester.set_width(tester.width_mult) else [tester.width_mult],
+                             reverse=True)
+        self.queue = queue.Queue()
+        self.stats = ServerStats()
+        self.logger = tester.logger
+        self.httpd = ThreadingHTTPServer((host, port), self.handler())
+        self.httpd.daemon_threads = True
+
+    def submit(self, img, width=None):
+        request = Request(img, width)
+        self.queue.put(request)
+        request.done.wait()
+        self.stats.record_request(time.perf_counter() - request.start, request.error is not None)
+        if request.error is not None:
+            raise request.error
+        return request.result, request.width_used
+
+    def default_width(self, queue_depth):
+        #ONE WIDTH STEP DOWN (FROM THE TESTER WIDTH) PER degrade_depth PAGES WAITING
+        widths = [width for width in self.widths if width <= self.tester.width_mult]
+        level = queue_depth // self.degrade_depth if self.degrade_depth > 0 else 0
+        return widths[min(level, len(widths) - 1)]
+
+    def collect(self):
+        """
+        Block until a request is queued, then collect up to `max_batch` requests within `max_wait`.
+        """
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def model_loop(self):
+        with torch.no_grad():
+            while True:
+                batch = self.collect()
+                queue_depth = self.queue.qsize() + len(batch)
+                self.stats.record_batch(len(batch), queue_depth)
+                default_width = self.default_width(queue_depth)
+                for request in batch:
+                    request.width_used = request.width if request.width is not None else default_width
+                #ONE PASS PER WIDTH OF THE BATCH
+                for width in sorted({request.width_used for request in batch}, reverse=True):
+                    group = [request for request in batch if request.width_used == width]
+                    self.stats.record_width(width, len(group))
+                    packer = TilePacker(self.tile_batch_size, self.tester.tile_size)
+                    try:
+                        self.tester.set_width(width)
+                        for i, request in enumerate(group):
+                            packer.add_page(i, request.img)
+                        for i, final_imgs in self.tester.drain(packer, flush=True):
+                            group[i].result = final_imgs
+                    except Exception as e:
+                        self.logger.exception("Batch failed")
+                        for request in group:
+                            request.error = e
+                self.tester.set_width(self.tester.width_mult)
+                for request in batch:
+                    request.done.set()
+
+    def handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send(self, code, body, content_type):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_json(self, code, obj):
+                self.send(code, json.dumps(obj).encode(), 'application/json')
+
+            def do_GET(self):
+                if self.path == '/stats':
+                    summary = server.stats.summary(server.queue.qsize())
+                    summary['tiles'] = dict(server.tester.tile_stats)
+                    summary['nfe'] = dict(server.tester.nfe_stats)
+                    if server.tester.cache is not None:
+                        summary['cache'] = server.tester.cache.summary()
+                    self.send_json(200, summary)
+                elif self.path == '/health':
+                    self.send_json(200, {'status': 'ok'})
+                else:
+                    self.send_json(404, {'error': 'not found'})
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                if url.path != '/binarize':
+                    self.send_json(404, {'error': 'not found'})
+                    return
+                width = parse_qs(url.query).get('width')
+                try:
+                    width = float(width[0]) if width else None
+                except ValueError:
+                    width = -1.
+                if width is not None and width not in server.widths:
+                    self.send_json(400, {'error': f'width must be one of {server.widths}'})
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                img = decode_image(self.rfile.read(length)) if length > 0 else None
+                if img is None:
+                    self.send_json(400, {'error': 'body is not a readable image'})
+                    return
+                #ANSWER CACHE HITS WITHOUT TOUCHING THE MODEL (THE CACHE HOLDS RESULTS AT THE TESTER WIDTH)
+                key, final_imgs = server.tester.lookup(img) if width in (None, server.tester.width_mult) else (None, None)
+                if final_imgs is None:
+                    try:
+                        final_imgs, width_used = server.submit(img, width)
+                    except Exception as e:
+                        self.send_json(500, {'error': str(e)})
+                        return
+                    if width_used == server.tester.width_mult:
+                        server.tester.store(key, final_imgs)
+                self.send(200, encode_binary(final_imgs), 'image/png')
+
+            def log_message(self, format, *args):
+                server.logger.debug(format % args)
+
+        return Handler
+
+    def serve_forever(self):
+        threading.Thread(target=self.model_loop, daemon=True).start()
+        self.logger.info(f"Serving on http://{self.host}:{self.port} (max batch {self.max_batch}, "
+                         f"max wait {1000 * self.max_wait:.0f} ms, widths {self.widths})")
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
@@ -5,7 +5,8 @@ import numpy as np
 from Binarization.schedule.schedule import Schedule
 from Binarization.model.NAFDPM import NAFDPM, EMA
 from Binarization.schedule.diffusionSample import GaussianDiffusion
-from Binarization.schedule.dpm_solver_pytorch import NoiseScheduleVP, model_wrapper, DPM_Solver
+from Binarization.schedule.solver_plan import build_solver, load_schedule
+from Binarization.model.slimmable import set_width
 import torch
 import torch.optim as optim
 import torch.nn as nn
@@ -13,7 +14,16 @@ from torch.utils.data import DataLoader
 from torchvision.utils import save_image
 from tqdm import tqdm
 import copy
-from Binarization.src.sobel import Laplacian
+from Binarization.src.sobel import Laplacian, Sobel
+from Binarization.src.tiling import TilePacker, split_tiles, merge_tiles, blank_tiles
+from Binarization.src.pipeline import InferencePipeline
+from Binarization.src.server import InferenceServer
+from Binarization.src.multiproc import MultiprocessInference
+from Binarization.src.cache import ResultCache, checkpoint_identity
+from Binarization.src.compiled import CompiledModule, enable_compile_cache
+from Binarization.src.onnx_backend import OrtModule, INIT_PREDICTOR_FILE, DENOISER_FILE
+from Binarization.src.quantization import prepare_ptq, convert, example_inputs, save_int8, load_int8, int8_exists, \
+    DENOISER_INT8_FILE
 import logging
 from collections import OrderedDict
 import pyiqa
@@ -60,7 +70,9 @@ class Tester:
             middle_blk_num  = config.MIDDLE_BLOCKS, 
             enc_blk_nums    = config.ENC_BLOCKS, 
             dec_blk_nums    = config.DEC_BLOCKS,
-            mode=1).to(self.device)
+            mode=1,
+            cond_encoder    = config.COND_ENCODER == 'True',
+            unshuffle       = config.PIXEL_UNSHUFFLE if config.PIXEL_UNSHUFFLE else 1).to(self.device)
         
         #DEFINE METRICS
         self.psnr = pyiqa.create_metric('psnr', device=self.device)
@@ -113,12 +125,76 @@ class Tester:
         self.TEST_DENOISER_WEIGHT_PATH = config.TEST_DENOISER_WEIGHT_PATH
         self.DPM_SOLVER = config.DPM_SOLVER
         self.DPM_STEP = config.DPM_STEP
+        self.dpm_method = config.DPM_METHOD if config.DPM_METHOD else 'singlestep'
+        self.dpm_order = config.DPM_ORDER if config.DPM_ORDER else 1
+        self.dpm_skip_type = config.DPM_SKIP_TYPE if config.DPM_SKIP_TYPE else 'time_uniform'
+        self.dpm_thresholding = config.DPM_THRESHOLDING if config.DPM_THRESHOLDING else 'exact'
+        self.dpm_t_start = config.DPM_T_START if config.DPM_T_START else 1.
+        self.early_stop = [config.EARLY_STOP_PATIENCE if config.EARLY_STOP_PATIENCE else 0,
+                           config.EARLY_STOP_TOLERANCE if config.EARLY_STOP_TOLERANCE else 0.]
+        self.dpm_schedule_path = config.DPM_SCHEDULE_PATH
+        if self.dpm_schedule_path and self.DPM_SOLVER == 'True':
+            #SEARCHED TIME GRID (SEE utils/search_schedule.py), REPLACES DPM_STEP, DPM_METHOD, DPM_ORDER AND DPM_SKIP_TYPE
+            searched = load_schedule(self.dpm_schedule_path, self.num_timesteps)
+            self.dpm_method, self.dpm_order, self.dpm_skip_type = searched['method'], searched['order'], searched['timesteps']
+            self.DPM_STEP, self.dpm_t_start = len(self.dpm_skip_type) - 1, self.dpm_skip_type[0]
+        self.ddim_steps = config.DDIM_STEPS
+        self.ddim_skip_type = config.DDIM_SKIP_TYPE if config.DDIM_SKIP_TYPE else 'uniform'
+        #DPM SOLVER TIME GRID AND COEFFICIENTS, BUILT ONCE AND REUSED FOR EVERY BATCH
+        self.dpm_tolerance = [config.DPM_ATOL if config.DPM_ATOL else 0.0078, config.DPM_RTOL if config.DPM_RTOL else 0.05,
+                              config.DPM_MAX_NFE]
+        self.solver_plan = build_solver(self.schedule.get_betas(), self.DPM_STEP, method=self.dpm_method,
+                                        order=self.dpm_order, skip_type=self.dpm_skip_type,
+                                        thresholding_method=self.dpm_thresholding, atol=self.dpm_tolerance[0],
+                                        rtol=self.dpm_tolerance[1], max_nfe=self.dpm_tolerance[2],
+                                        t_start=self.dpm_t_start) \
+            if self.DPM_SOLVER == 'True' else None
         self.beta_loss = config.BETA_LOSS
         self.pre_ori = config.PRE_ORI
         self.high_low_freq = config.HIGH_LOW_FREQ
         self.image_size = config.IMAGE_SIZE
         self.native_resolution = config.NATIVE_RESOLUTION
         self.validate_every = config.VALIDATE_EVERY
+        self.tile_size = config.TILE_SIZE if config.TILE_SIZE else 256
+        self.tile_batch_size = config.TILE_BATCH_SIZE
+        self.decode_workers = config.DECODE_WORKERS if config.DECODE_WORKERS else 2
+        self.encode_workers = config.ENCODE_WORKERS if config.ENCODE_WORKERS else 2
+        self.prefetch_pages = config.PREFETCH_PAGES if config.PREFETCH_PAGES else 8
+        self.server_host = config.SERVER_HOST if config.SERVER_HOST else '127.0.0.1'
+        self.server_port = config.SERVER_PORT if config.SERVER_PORT else 8080
+        self.server_max_batch = config.SERVER_MAX_BATCH if config.SERVER_MAX_BATCH else 8
+        self.server_max_wait_ms = config.SERVER_MAX_WAIT_MS if config.SERVER_MAX_WAIT_MS is not None else 20
+        self.server_degrade_depth = config.SERVER_DEGRADE_DEPTH if config.SERVER_DEGRADE_DEPTH else 0
+        #SLIMMABLE NETWORKS: WIDTHS THEY WERE TRAINED WITH, AND THE ONE USED
+        self.slim_widths = sorted(set(config.SLIM_WIDTHS if config.SLIM_WIDTHS else []) | {1.})
+        self.width_mult = config.WIDTH_MULT if config.WIDTH_MULT else 1.
+        self.backend = config.BACKEND if config.BACKEND else 'torch'
+        self.onnx_path = config.ONNX_PATH
+        self.onnx_threads = config.ONNX_THREADS
+        self.int8 = config.INT8 == 'True'
+        self.int8_path = config.INT8_PATH
+        self.calibration_path_img = config.CALIBRATION_PATH_IMG if config.CALIBRATION_PATH_IMG else config.TEST_PATH_IMG
+        self.calibration_path_gt = config.CALIBRATION_PATH_GT if config.CALIBRATION_PATH_GT else config.TEST_PATH_GT
+        self.calibration_pages = config.CALIBRATION_PAGES if config.CALIBRATION_PAGES else 8
+        self.channels_x = config.CHANNEL_X
+        self.compile = config.COMPILE == 'True'
+        self.time_cache = config.TIME_CACHE == 'True'
+        self.feature_cache = [config.FEATURE_CACHE_DEPTH if config.FEATURE_CACHE_DEPTH else 0,
+                              config.FEATURE_CACHE_SCHEDULE if config.FEATURE_CACHE_SCHEDULE else 2]
+        self.compile_cache_dir = config.COMPILE_CACHE_DIR
+        self.num_processes = config.NUM_PROCESSES
+        self.threads_per_process = config.THREADS_PER_PROCESS if config.THREADS_PER_PROCESS else 1
+        self.pin_cores = config.PIN_CORES == 'True'
+        self.blank_tile_std = config.BLANK_TILE_STD
+        self.blank_tile_edge = config.BLANK_TILE_EDGE if config.BLANK_TILE_EDGE else None
+        self.sobel = Sobel().to(self.device) if self.blank_tile_edge else None
+        self.cascade_margin = config.CASCADE_MARGIN
+        self.cascade_uncertain_fraction = config.CASCADE_UNCERTAIN_FRACTION if config.CASCADE_UNCERTAIN_FRACTION else 0.
+        self.tile_stats = OrderedDict(tiles=0, blank=0, refined=0)
+        self.nfe_stats = OrderedDict(batches=0, nfe=0, tiles=0, tile_evals=0, reused=0)
+        #RESULT CACHE, OPENED BY load_checkpoints ONCE THE SETTINGS THAT RUN ARE KNOWN
+        self.config = config
+        self.cache = None
 
  
         #DATASETS AND DATALOADERS
@@ -132,6 +208,9 @@ class Tester:
             self.dataloader_test = DataLoader(dataset_test, batch_size=config.BATCH_SIZE_VAL, shuffle=False,
                                               drop_last=False,
                                               num_workers=config.NUM_WORKERS)
+        elif self.mode in [3, 4]:
+            #INFERENCE ONLY, PAGES ARE STREAMED FROM TEST_PATH_IMG OR RECEIVED BY THE SERVER WITHOUT GT
+            self.dataloader_test = None
         else:
             print(config.TEST_PATH_IMG)
             dataset_test = DocData(config.TEST_PATH_IMG, config.TEST_PATH_GT, config.IMAGE_SIZE, self.mode)
@@ -172,6 +251,7 @@ class Tester:
                  "iterations": self.iteration_max,
                  "Native": self.native_resolution,
                  "DPM_Solver": self.DPM_SOLVER,
+                 "DPM_Method": [self.dpm_method, self.dpm_order, self.dpm_skip_type, self.DPM_STEP],
                  "Sampling_Steps": config.TIMESTEPS
                 })
 
@@ -188,107 +268,338 @@ class Tester:
             wandb.define_metric("drd", summary="max")
 
 
+    def load_checkpoints(self):
+        #LOAD CHECKPOINTS FOR INITIAL PREDICTOR AND DENOISER
+        checkpoint_init = torch.load(self.TEST_INITIAL_PREDICTOR_WEIGHT_PATH, weights_only=False)
+        checkpoint_denoiser = torch.load(self.TEST_DENOISER_WEIGHT_PATH, weights_only=False)
+        self.network.init_predictor.load_state_dict(checkpoint_init['model_state_dict'])
+        self.network.denoiser.load_state_dict(checkpoint_denoiser['model_state_dict'])
+        sampler = checkpoint_denoiser.get('sampler')
+        if sampler is not None and self.DPM_SOLVER == 'True':
+            #DISTILLED DENOISER (MODE 5): SAMPLE WITH THE FEW STEP SOLVER IT WAS TRAINED FOR, FROM t = T
+            overridden = [name for name, value, distilled in (
+                ('DPM_SCHEDULE_PATH', self.dpm_schedule_path or None, None), ('DPM_STEP', self.DPM_STEP, sampler['steps']),
+                ('DPM_METHOD', self.dpm_method, sampler['method']), ('DPM_ORDER', self.dpm_order, sampler['order']),
+                ('DPM_SKIP_TYPE', self.dpm_skip_type, sampler['skip_type']), ('DPM_T_START', self.dpm_t_start, 1.))
+                if value != distilled]
+            if overridden:
+                self.logger.warning(f"Distilled denoiser: {', '.join(overridden)} ignored, "
+                                    f"sampling with the solver it was distilled for")
+            self.DPM_STEP, self.dpm_method = sampler['steps'], sampler['method']
+            self.dpm_order, self.dpm_skip_type = sampler['order'], sampler['skip_type']
+            self.dpm_t_start, self.dpm_schedule_path = 1., None
+            self.solver_plan = build_solver(self.schedule.get_betas(), self.DPM_STEP, method=self.dpm_method,
+                                            order=self.dpm_order, skip_type=self.dpm_skip_type,
+                                            thresholding_method=self.dpm_thresholding)
+            self.logger.info(f"Distilled denoiser: {self.DPM_STEP} {self.dpm_method} steps")
+        if self.backend == 'onnx':
+            #RUN THE EXPORTED NETWORKS WITH ONNX RUNTIME (SEE utils/export_onnx.py)
+            self.network.init_predictor = OrtModule(os.path.join(self.onnx_path, INIT_PREDICTOR_FILE), self.onnx_threads)
+            self.network.denoiser = OrtModule(os.path.join(self.onnx_path, DENOISER_FILE), self.onnx_threads)
+        elif self.int8:
+            self.quantize_networks()
+        elif self.compile:
+            #COMPILE THE NETWORKS, BATCHES ARE PADDED TO POWER OF TWO BUCKETS TO LIMIT RECOMPILATIONS
+            if self.compile_cache_dir:
+                enable_compile_cache(self.compile_cache_dir)
+            self.network.init_predictor = CompiledModule(self.network.init_predictor)
+            self.network.denoiser = CompiledModule(self.network.denoiser)
+        if self.time_cache:
+            if hasattr(self.network.denoiser, 'enable_time_cache'):
+                #PRECOMPUTE THE TIME MODULATION OF THE SOLVER TIMESTEPS ONCE
+                self.network.denoiser.enable_time_cache()
+            else:
+                self.logger.warning("TIME_CACHE is only supported by the float PyTorch denoiser, ignored")
+                self.time_cache = False
+        if self.width_mult != 1 and not self.set_width(self.width_mult):
+            self.logger.warning("WIDTH_MULT is only supported by the float PyTorch networks, running the full width")
+            self.width_mult = 1.
+        if self.feature_cache[0] > 0:
+            if hasattr(self.network.denoiser, 'enable_feature_cache'):
+                #REUSE THE DEEP FEATURES OF THE DENOISER BETWEEN SOLVER STEPS
+                self.network.denoiser.enable_feature_cache(*self.feature_cache)
+            else:
+                self.logger.warning("FEATURE_CACHE_DEPTH is only supported by the float PyTorch denoiser, ignored")
+                self.feature_cache[0] = 0
+        self.diffusion = GaussianDiffusion(self.network.denoiser, self.num_timesteps, self.schedule).to(self.device)
+        if self.config.CACHE_PATH and self.mode != 1:
+            max_mb = self.config.CACHE_MAX_MB if self.config.CACHE_MAX_MB else 1024
+            self.cache = ResultCache(self.config.CACHE_PATH, max_mb * 2 ** 20, self.cache_settings(self.config))
+        print('Test Model loaded')
+
+    def set_width(self, width_mult):
+        """
+        Run both networks with `width_mult` times their channels (slimmable networks, see SLIM_WIDTHS).
+        Returns False if the networks do not support it (ONNX, int8 or compiled).
+        """
+        if not all(hasattr(network, 'width_mult') for network in [self.network.init_predictor, self.network.denoiser]):
+            return False
+        set_width(self.network, width_mult)
+        return True
+
+    def quantize_networks(self):
+        """
+        Replace the initial predictor and the denoiser with their int8 version (CPU only).
+        The int8 networks are loaded from INT8_PATH if they exist, otherwise they are obtained by
+        post-training quantization calibrated on CALIBRATION_PATH_IMG and saved to INT8_PATH.
+        """
+        if self.device.type != 'cpu':
+            self.logger.warning("INT8 is only supported on CPU, running the float networks")
+            return
+        if int8_exists(self.int8_path):
+            init_predictor, denoiser = load_int8(self.network, self.int8_path, self.channels_x, self.out_channels,
+                                                 self.tile_size)
+            self.logger.info(f"Loaded int8 networks from {self.int8_path}")
+        else:
+            self.network.init_predictor = prepare_ptq(self.network.init_predictor,
+                                                      example_inputs('init_predictor', self.channels_x, self.tile_size))
+            self.network.denoiser = prepare_ptq(self.network.denoiser,
+                                                example_inputs('denoiser', self.out_channels, self.tile_size))
+            self.diffusion = GaussianDiffusion(self.network.denoiser, self.num_timesteps, self.schedule).to(self.device)
+            self.calibrate()
+            init_predictor, denoiser = convert(self.network.init_predictor), convert(self.network.denoiser)
+            save_int8(init_predictor, denoiser, self.int8_path)
+            self.logger.info(f"Saved int8 networks to {self.int8_path}")
+        self.network.init_predictor = init_predictor
+        self.network.denoiser = denoiser
+
+    def calibrate(self):
+        """
+        Run CALIBRATION_PAGES pages of CALIBRATION_PATH_IMG through the initial predictor and the sampler,
+        so the observers of the networks prepared for quantization record the activation ranges.
+        """
+        from Binarization.data.docdata import DocData
+        dataset = DocData(self.calibration_path_img, self.calibration_path_gt, self.image_size, 0)
+        batch_size = self.tile_batch_size if self.tile_batch_size else 16
+        with torch.no_grad():
+            for i in tqdm(range(min(self.calibration_pages, len(dataset))), desc='Calibration'):
+                img, _, _ = dataset[i]
+                img = img.unsqueeze(0)
+                if self.native_resolution == 'True':
+                    img = split_tiles(img, self.tile_size)
+                for batch in img.split(batch_size):
+                    init_predict = self.network.init_predictor(batch.to(self.device))
+                    self.sample(init_predict)
+
+    def cache_settings(self, config):
+        #EVERYTHING THE RESULT OF A PAGE DEPENDS ON, BESIDES ITS PIXELS
+        return {
+            'init_predictor': checkpoint_identity(self.TEST_INITIAL_PREDICTOR_WEIGHT_PATH),
+            'denoiser': checkpoint_identity(self.TEST_DENOISER_WEIGHT_PATH),
+            'model': [config.MODEL_CHANNELS, config.MIDDLE_BLOCKS, config.ENC_BLOCKS, config.DEC_BLOCKS]
+                     + (['cond_encoder'] if config.COND_ENCODER == 'True' else [])
+                     + ([f'unshuffle_{config.PIXEL_UNSHUFFLE}'] if (config.PIXEL_UNSHUFFLE or 1) > 1 else []),
+            'schedule': [config.SCHEDULE, config.TIMESTEPS, self.pre_ori],
+            'sampler': [self.DPM_SOLVER, self.DPM_STEP, self.dpm_method, self.dpm_order, self.dpm_skip_type,
+                        self.dpm_thresholding, self.dpm_t_start] + (self.dpm_tolerance if self.dpm_method == 'adaptive' else [])
+                       + (self.early_stop if self.early_stop[0] > 0 and self.dpm_method != 'adaptive' else [])
+                       + ([self.ddim_steps, self.ddim_skip_type] if self.DPM_SOLVER != 'True' else []),
+            'backend': [self.backend] + (checkpoint_identity(os.path.join(self.onnx_path, DENOISER_FILE))
+                                         if self.backend == 'onnx' else []),
+            'int8': checkpoint_identity(os.path.join(self.int8_path, DENOISER_INT8_FILE)) if self.int8 else None,
+            'tiles': [self.native_resolution, self.tile_size, config.IMAGE_SIZE],
+            'blank': [self.blank_tile_std, self.blank_tile_edge],
+            'cascade': [self.cascade_margin, self.cascade_uncertain_fraction],
+            'feature_cache': self.feature_cache if self.feature_cache[0] > 0 else None,
+            'width': self.width_mult if self.width_mult != 1 else None,
+        }
+
+    def lookup(self, img):
+        """
+        Look up the page `img` (1, C, H, W) in the result cache.
+        Returns (key, final_imgs), final_imgs is None on a miss (key is None if the cache is disabled).
+        """
+        if self.cache is None:
+            return None, None
+        key = self.cache.key(img)
+        return key, self.cache.get(key)
+
+    def store(self, key, final_imgs):
+        if key is not None:
+            self.cache.put(key, final_imgs)
+
+    def restore(self, img):
+        """
+        Restore a batch of images (or tiles). Returns the final images (not clamped).
+        If BLANK_TILE_STD is set, near-uniform tiles skip the networks and are set to the binarization of
+        their mean intensity: background (ones) for light tiles, ink (zeros) for dark ones.
+        """
+        img = img.to(self.device)
+        self.tile_stats['tiles'] += img.shape[0]
+        if self.blank_tile_std:
+            blank = blank_tiles(img, self.blank_tile_std, self.blank_tile_edge, self.sobel)
+            n_blank = int(blank.sum())
+            if n_blank > 0:
+                self.tile_stats['blank'] += n_blank
+                final_imgs = (img.mean(dim=(1, 2, 3)) > 0.5).to(img.dtype)[:, None, None, None].expand(
+                    img.shape[0], self.out_channels, *img.shape[2:]).clone()
+                if n_blank < img.shape[0]:
+                    final_imgs[~blank] = self.refine(img[~blank])
+                return final_imgs
+        return self.refine(img)
+
+    def refine(self, img):
+        """
+        Run the initial predictor and the residual refinement on a batch of images (or tiles).
+        Returns the final images sampled residual + initial prediction (not clamped).
+        If CASCADE_MARGIN is set, only the uncertain tiles (see uncertain_tiles) are refined,
+        the final images of the other ones are their initial prediction.
+        """
+        #FIRST INITIAL PREDICTION
+        init_predict = self.network.init_predictor(img.to(self.device))
+
+        #CASCADE: REFINE ONLY THE TILES WITH AN UNCERTAIN INITIAL PREDICTION
+        if self.cascade_margin:
+            uncertain = self.uncertain_tiles(init_predict)
+            n_uncertain = int(uncertain.sum())
+            self.tile_stats['refined'] += n_uncertain
+            if n_uncertain < img.shape[0]:
+                final_imgs = init_predict.clone()
+                if n_uncertain > 0:
+                    final_imgs[uncertain] = self.sample(init_predict[uncertain]) + init_predict[uncertain]
+                return final_imgs
+        else:
+            self.tile_stats['refined'] += img.shape[0]
+
+        #COMPUTE FINAL IMAGES
+        return self.sample(init_predict) + init_predict
+
+    def uncertain_tiles(self, init_predict):
+        """
+        A tile is uncertain if more than CASCADE_UNCERTAIN_FRACTION of its pixels have an initial
+        prediction within CASCADE_MARGIN of the 0.5 binarization threshold.
+        Returns a bool mask of shape (N,).
+        """
+        near_threshold = (init_predict - 0.5).abs() < self.cascade_margin
+        return near_threshold.flatten(1).float().mean(dim=1) > self.cascade_uncertain_fraction
+
+    def sample(self, init_predict):
+        """
+        Sample the residual images conditioned on `init_predict` using DPM solver or DDIM.
+        """
+        #INIT RANDOM NOISE
+        noisyImage = torch.randn_like(init_predict)
+        if self.feature_cache[0] > 0:
+            self.network.denoiser.reset_feature_cache()
+            reused = self.network.denoiser.feature_cache_stats['reused']
+
+        #REFINE RESIDUAL IMAGE USING DPM SOLVER OR DDIM
+        if self.DPM_SOLVER == 'True':
+            #DPM SOLVER BRANCH (NOISED ZERO RESIDUAL IF DPM_T_START < 1, CONVERGED TILES RETIRED IF EARLY_STOP_PATIENCE > 0)
+            if self.dpm_method == 'adaptive':
+                sampledImgs = self.solver_plan.sample(self.network.denoiser, self.solver_plan.initial_state(noisyImage),
+                                                      init_predict)
+            else:
+                sampledImgs = self.solver_plan.sample(self.network.denoiser, self.solver_plan.initial_state(noisyImage),
+                                                      init_predict, *self.early_stop)
+            self.nfe_stats['batches'] += 1
+            #EVALUATIONS RUN, FEWER THAN THE PLAN NFE IF EARLY STOP RETIRED EVERY TILE
+            self.nfe_stats['nfe'] += self.solver_plan.evals
+            self.nfe_stats['tiles'] += init_predict.shape[0]
+            self.nfe_stats['tile_evals'] += self.solver_plan.tile_evals
+            if self.dpm_method == 'adaptive':
+                self.logger.info(f"adaptive solver: {self.solver_plan.nfe} NFE for a batch of {init_predict.shape[0]}")
+        else:
+            #DDIM BRANCH
+            sampledImgs = self.diffusion(noisyImage, init_predict, self.pre_ori, self.ddim_steps, self.ddim_skip_type)
+            self.nfe_stats['batches'] += 1
+            nfe = len(self.diffusion.plan(self.ddim_steps, self.ddim_skip_type, self.pre_ori))
+            self.nfe_stats['nfe'] += nfe
+            self.nfe_stats['tiles'] += init_predict.shape[0]
+            self.nfe_stats['tile_evals'] += nfe * init_predict.shape[0]
+        if self.feature_cache[0] > 0:
+            #DENOISER CALLS OF THE BATCH THAT REUSED THE DEEP FEATURES
+            self.nfe_stats['reused'] += self.network.denoiser.feature_cache_stats['reused'] - reused
+        return sampledImgs
+
+    def drain(self, packer, flush=False):
+        """
+        Restore the full tile batches queued in `packer` (all the queued tiles if `flush`)
+        and return the list of (name, final_imgs) of the completed pages.
+        """
+        while True:
+            batch = packer.next_batch(flush=flush)
+            if batch is None:
+                break
+            tiles, slots = batch
+            packer.scatter(slots, self.restore(tiles).cpu())
+        return packer.pop_finished()
+
+    def log_tile_stats(self):
+        tiles = max(self.tile_stats['tiles'], 1)
+        self.logger.info(", ".join(f"{key}: {value} ({100. * value / tiles:.1f}%)" if key != 'tiles' else f"{key}: {value}"
+                                   for key, value in self.tile_stats.items()))
+        if self.nfe_stats['batches'] > 0:
+            self.logger.info(f"denoiser evaluations: {self.nfe_stats['nfe']} in {self.nfe_stats['batches']} batches "
+                             f"({self.nfe_stats['nfe'] / self.nfe_stats['batches']:.1f} NFE per batch, "
+                             f"{self.nfe_stats['tile_evals'] / max(self.nfe_stats['tiles'], 1):.1f} per tile)")
+        if self.nfe_stats['reused'] > 0:
+            self.logger.info(f"feature cache: {self.nfe_stats['reused']} of {self.nfe_stats['nfe']} denoiser calls "
+                             f"reused the deep features")
+        if self.cache is not None:
+            summary = self.cache.summary()
+            self.logger.info(f"cache hits: {summary['hits']}, misses: {summary['misses']}, size: {summary['size_mb']:.1f} MB")
+
+    def save_result(self, final_imgs, name):
+        final_imgs = torch.clamp(final_imgs, 0, 1)
+        name_str, _ = os.path.splitext(name)
+        save_image((final_imgs > 0.5).float(), os.path.join(
+            self.test_img_save_path, f"{name_str}.png"), nrow=1)
+
     def test(self):
-        def crop_concat(img, size=256):
-            shape = img.shape
-            correct_shape = (size*(shape[2]//size+1), size*(shape[3]//size+1))
-            one = torch.ones((shape[0], shape[1], correct_shape[0], correct_shape[1]))
-            one[:, :, :shape[2], :shape[3]] = img
-            # crop
-            for i in range(shape[2]//size+1):
-                for j in range(shape[3]//size+1):
-                    if i == 0 and j == 0:
-                        crop = one[:, :, i*size:(i+1)*size, j*size:(j+1)*size]
-                    else:
-                        crop = torch.cat((crop, one[:, :, i*size:(i+1)*size, j*size:(j+1)*size]), dim=0)
-            return crop
-        def crop_concat_back(img, prediction, size=256):
-            shape = img.shape
-            for i in range(shape[2]//size+1):
-                for j in range(shape[3]//size+1):
-                    if j == 0:
-                        crop = prediction[(i*(shape[3]//size+1)+j)*shape[0]:(i*(shape[3]//size+1)+j+1)*shape[0], :, :, :]
-                    else:
-                        crop = torch.cat((crop, prediction[(i*(shape[3]//size+1)+j)*shape[0]:(i*(shape[3]//size+1)+j+1)*shape[0], :, :, :]), dim=3)
-                if i == 0:
-                    crop_concat = crop
-                else:
-                    crop_concat = torch.cat((crop_concat, crop), dim=2)
-            return crop_concat[:, :, :shape[2], :shape[3]]
-
-        def min_max(array):
-            return (array - array.min()) / (array.max() - array.min())
-        
         with torch.no_grad():
-            #LOAD CHECKPOINTS FOR INITIAL PREDICTOR AND DENOISER
-            checkpoint_init = torch.load(self.TEST_INITIAL_PREDICTOR_WEIGHT_PATH, weights_only=False)
-            checkpoint_denoiser = torch.load(self.TEST_DENOISER_WEIGHT_PATH, weights_only=False)
-            self.network.init_predictor.load_state_dict(checkpoint_init['model_state_dict'])
-            self.network.denoiser.load_state_dict(checkpoint_denoiser['model_state_dict'])
-            #self.network.init_predictor.load_state_dict(torch.load(self.TEST_INITIAL_PREDICTOR_WEIGHT_PATH))
-            #self.network.denoiser.load_state_dict(torch.load(self.TEST_DENOISER_WEIGHT_PATH))
-            self.diffusion = GaussianDiffusion(self.network.denoiser, self.num_timesteps, self.schedule).to(self.device)
-            print('Test Model loaded')
-            
+            self.load_checkpoints()
+
             #PUT EVERYTHING IN EVALUATION MODE
             self.network.eval()
             tq = tqdm(self.dataloader_test)
-            sampler = self.diffusion
             iteration = 0
-            
-            #INIT METRICS DICTIONARY
-            # test_results = OrderedDict()
-            # test_results["psnr"] = []
-            # test_results["ssim"] = []
-            # test_results["fmeasure"] = []
-            # test_results["pseudof"] = []
-            # test_results["drd"] = []
+
+            #PACK TILES OF MULTIPLE PAGES IN FIXED SIZE BATCHES
+            if self.native_resolution == 'True' and self.tile_batch_size:
+                packer = TilePacker(self.tile_batch_size, self.tile_size)
+                keys = {}
+                for img, gt, name in tq:
+                    tq.set_description(f'Iteration {iteration} / {len(self.dataloader_test.dataset)}')
+                    iteration += img.shape[0]
+                    for i in range(img.shape[0]):
+                        key, final_imgs = self.lookup(img[i:i + 1])
+                        if final_imgs is not None:
+                            self.save_result(final_imgs, name[i])
+                            continue
+                        keys[name[i]] = key
+                        packer.add_page(name[i], img[i:i + 1])
+                    for page_name, final_imgs in self.drain(packer):
+                        self.store(keys.pop(page_name), final_imgs)
+                        self.save_result(final_imgs, page_name)
+                for page_name, final_imgs in self.drain(packer, flush=True):
+                    self.store(keys.pop(page_name), final_imgs)
+                    self.save_result(final_imgs, page_name)
+                self.log_tile_stats()
+                return
 
             #FOR IMAGES IN TESTING DATASET
             for img, gt, name in tq:
                 tq.set_description(f'Iteration {iteration} / {len(self.dataloader_test.dataset)}')
                 iteration += 1
+                key, final_imgs = self.lookup(img)
+                if final_imgs is not None:
+                    self.save_result(final_imgs, name[0])
+                    continue
+
                 #IF NATIVE DIVIDE IMAGES IN SUBIMAGES
                 if self.native_resolution == 'True':
                     temp = img
-                    img = crop_concat(img)
-                    
-                #INIT RANDOM NOISE
-                noisyImage = torch.randn_like(img).to(self.device)
-                
-                #FIRST INITIAL PREDICTION
-                init_predict = self.network.init_predictor(img.to(self.device))
-
-                #REFINE RESIDUAL IMAGE USING DPM SOLVER OR DDIM
-                if self.DPM_SOLVER == 'True':
-                    #DPM SOLVER BRANCH
-                    sampledImgs = dpm_solver(self.schedule.get_betas(), self.network.denoiser,
-                                             noisyImage, self.DPM_STEP, init_predict, model_kwargs={})
-                
-                else:
-                    #DDIM BRANCH
-                    sampledImgs = sampler(noisyImage.cuda(), init_predict, self.pre_ori)
-                    
-                #COMPUTE FINAL IMAGES   
-                final_imgs = (sampledImgs + init_predict)
-                
-                #IF NATIVE RESOLUTION RECONSTRUCT FINAL IMAGES FROM MULTIPLE SUBIMAGES
-                if self.native_resolution == 'True':
-                    final_imgs = crop_concat_back(temp, final_imgs)
-                    init_predict = crop_concat_back(temp, init_predict)
-                    sampledImgs = crop_concat_back(temp, sampledImgs)
-                    img = temp
-
+                    img = split_tiles(img, self.tile_size)
 
-                final_imgs = torch.clamp(final_imgs,0,1)
-                #img_save = torch.cat((img, gt, init_predict.cpu(), min_max(sampledImgs.cpu()), finalImgs.cpu()), dim=3)
-                #save_image(img_save, os.path.join(
-                #    self.test_img_save_path, f"{name[0]}.png"), nrow=4)
+                final_imgs = self.restore(img)
 
-                name_str, _ = os.path.splitext(name[0])
+                #IF NATIVE RESOLUTION RECONSTRUCT FINAL IMAGES FROM MULTIPLE SUBIMAGES
+                if self.native_resolution == 'True':
+                    final_imgs = merge_tiles(final_imgs, temp.shape, self.tile_size)
+                self.store(key, final_imgs.cpu())
 
-                save_image((final_imgs>0.5).float(), os.path.join(
-                    self.test_img_save_path, f"{name_str}.png"), nrow=1)
+                self.save_result(final_imgs, name[0])
 
                                 #METRIC COMPUTATION
 
@@ -347,53 +658,40 @@ class Tester:
             #
             #     wandb.finish()
 
+            self.log_tile_stats()
+
+
+    def infer(self):
+        with torch.no_grad():
+            self.load_checkpoints()
 
-def dpm_solver(betas, model, x_T, steps, condition, model_kwargs):
-    # You need to firstly define your model and the extra inputs of your model,
-    # And initialize an `x_T` from the standard normal distribution.
-    # `model` has the format: model(x_t, t_input, **model_kwargs).
-    # If your model has no extra inputs, just let model_kwargs = {}.
-
-    # If you use discrete-time DPMs, you need to further define the
-    # beta arrays for the noise schedule.
-
-    # model = ....
-    # model_kwargs = {...}
-    # x_T = ...
-    # betas = ....
-
-    # 1. Define the noise schedule.
-    noise_schedule = NoiseScheduleVP(schedule='discrete', betas=betas)
-
-    # 2. Convert your discrete-time `model` to the continuous-time
-    # noise prediction model. Here is an example for a diffusion model
-    # `model` with the noise prediction type ("noise") .
-    model_fn = model_wrapper(
-        model,
-        noise_schedule,
-        model_type="x_start",  # or "x_start" or "v" or "score"
-        model_kwargs=model_kwargs,
-        guidance_type="classifier-free",
-        condition=condition
-    )
-
-    # 3. Define dpm-solver and sample by singlestep DPM-Solver.
-    # (We recommend singlestep DPM-Solver for unconditional sampling)
-    # You can adjust the `steps` to balance the computation
-    # costs and the sample quality.
-    dpm_solver = DPM_Solver(model_fn, noise_schedule, algorithm_type="dpmsolver++",
-                            correcting_x0_fn="dynamic_thresholding")
-    # Can also try
-    # dpm_solver = DPM_Solver(model_fn, noise_schedule, algorithm_type="dpmsolver++")
-
-    # You can use steps = 10, 12, 15, 20, 25, 50, 100.
-    # Empirically, we find that steps in [10, 20] can generate quite good samples.
-    # And steps = 20 can almost converge.
-    x_sample = dpm_solver.sample(
-        x_T,
-        steps=steps,
-        order=1,
-        skip_type="time_uniform",
-        method="singlestep",
-    )
-    return x_sample
+            #PUT EVERYTHING IN EVALUATION MODE
+            self.network.eval()
+            if self.num_processes and self.num_processes > 1:
+                if self.device.type == 'cpu':
+                    MultiprocessInference(self, self.test_path_img, self.test_img_save_path, self.num_processes,
+                                          threads_per_process=self.threads_per_process,
+                                          pin_cores=self.pin_cores,
+                                          batch_size=self.tile_batch_size if self.tile_batch_size else 16).run()
+                    self.log_tile_stats()
+                    return
+                self.logger.warning("NUM_PROCESSES is only supported on CPU, running a single process")
+            pipeline = InferencePipeline(self, self.test_path_img, self.test_img_save_path,
+                                         batch_size=self.tile_batch_size if self.tile_batch_size else 16,
+                                         decode_workers=self.decode_workers,
+                                         encode_workers=self.encode_workers,
+                                         prefetch=self.prefetch_pages)
+            pipeline.run()
+            self.log_tile_stats()
+
+    def serve(self):
+        self.load_checkpoints()
+
+        #PUT EVERYTHING IN EVALUATION MODE
+        self.network.eval()
+        server = InferenceServer(self, host=self.server_host, port=self.server_port,
+                                 max_batch=self.server_max_batch,
+                                 max_wait=self.server_max_wait_ms / 1000.,
+                                 tile_batch_size=self.tile_batch_size if self.tile_batch_size else 16,
+                                 degrade_depth=self.server_degrade_depth)
+        server.serve_forever()
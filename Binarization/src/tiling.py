@@ -0,0 +1,138 @@
+from collections import OrderedDict, deque
+
+import torch
+
+
+def split_tiles(img, size=256):
+    """
+    Split a batch of pages (B, C, H, W) in the row-major grid of `size` x `size` tiles.
+    The page is padded with ones up to (H // size + 1, W // size + 1) tiles, the tile of row i,
+    column j of page b is at index (i * cols + j) * B + b (same layout as crop_concat).
+    """
+    B, C, H, W = img.shape
+    rows, cols = H // size + 1, W // size + 1
+    one = torch.ones((B, C, rows * size, cols * size), dtype=img.dtype, device=img.device)
+    one[:, :, :H, :W] = img
+    tiles = one.reshape(B, C, rows, size, cols, size).permute(2, 4, 0, 1, 3, 5)
+    return tiles.reshape(rows * cols * B, C, size, size)
+
+
+def merge_tiles(prediction, shape, size=256):
+    """
+    Inverse of split_tiles: rebuild the (B, C, H, W) pages of shape `shape` from their tiles.
+    """
+    B, _, H, W = shape
+    rows, cols = H // size + 1, W // size + 1
+    C = prediction.shape[1]
+    pages = prediction.reshape(rows, cols, B, C, size, size).permute(2, 3, 0, 4, 1, 5)
+    return pages.reshape(B, C, rows * size, cols * size)[:, :, :H, :W]
+
+
+def blank_tiles(tiles, max_std, max_edge=None, sobel=None):
+    """
+    Mark the near-uniform (blank/background) tiles of a batch (N, C, H, W).
+
+    A tile is blank if the standard deviation of its intensities is at most `max_std` and, if
+    `max_edge` is given, the max Sobel gradient magnitude inside the tile (border excluded, as
+    the filter is zero padded) is at most `max_edge`.
+    Returns a bool mask of shape (N,).
+    """
+    blank = tiles.flatten(1).std(dim=1) <= max_std
+    if max_edge is not None and sobel is not None and blank.any():
+        edges = sobel(tiles[blank])[:, :, 1:-1, 1:-1]
+        blank[blank.clone()] = edges.flatten(1).amax(dim=1) <= max_edge
+    return blank
+
+
+class TilePacker:
+    """
+    Tile packing scheduler for batched inference.
+
+    Pages are split in tiles when added, tiles of many pages are packed in batches of
+    `batch_size` tiles, and the outputs are scattered back to a per page canvas. Pages are
+    returned by pop_finished in the same order they have been added.
+
+    Example:
+        >>> packer = TilePacker(batch_size=64, tile_size=256)
+        >>> packer.add_page(name, img)
+        >>> while (batch := packer.next_batch(flush=True)) is not None:
+        >>>     tiles, slots = batch
+        >>>     packer.scatter(slots, model(tiles))
+        >>> for name, final in packer.pop_finished(): ...
+    """
+
+    def __init__(self, batch_size, tile_size=256):
+        self.batch_size = batch_size
+        self.tile_size = tile_size
+        self.pages = OrderedDict()
+        self.queue = deque()
+        self.queued_tiles = 0
+
+    def __len__(self):
+        return len(self.pages)
+
+    def add_page(self, key, img):
+        """
+        Add a page (1, C, H, W) identified by `key` and enqueue its tiles.
+        """
+        if key in self.pages:
+            raise ValueError("Page {} is already in the packer".format(key))
+        tiles = split_tiles(img, self.tile_size)
+        self.pages[key] = {'shape': img.shape, 'tiles': tiles, 'canvas': None, 'pending': tiles.shape[0]}
+        self.queue.append([key, 0])
+        self.queued_tiles += tiles.shape[0]
+
+    def next_batch(self, flush=False):
+        """
+        Pop the next batch of tiles.
+
+        Returns None if there are no queued tiles, or if less than `batch_size` tiles are queued
+        and `flush` is False. Otherwise returns (tiles, slots), where slots is the list of
+        (key, start, end) page ranges packed in the batch, needed by scatter.
+        """
+        if self.queued_tiles == 0 or (self.queued_tiles < self.batch_size and not flush):
+            return None
+        crops, slots = [], []
+        free = self.batch_size
+        while free > 0 and self.queue:
+            key, start = self.queue[0]
+            tiles = self.pages[key]['tiles']
+            end = min(start + free, tiles.shape[0])
+            crops.append(tiles[start:end])
+            slots.append((key, start, end))
+            free -= end - start
+            if end == tiles.shape[0]:
+                self.queue.popleft()
+                self.pages[key]['tiles'] = None
+            else:
+                self.queue[0][1] = end
+        self.queued_tiles -= self.batch_size - free
+        return torch.cat(crops, dim=0), slots
+
+    def scatter(self, slots, outputs):
+        """
+        Write the `outputs` of a batch returned by next_batch back to the page canvases.
+        """
+        offset = 0
+        for key, start, end in slots:
+            page = self.pages[key]
+            if page['canvas'] is None:
+                B, _, H, W = page['shape']
+                n_tiles = (H // self.tile_size + 1) * (W // self.tile_size + 1) * B
+                page['canvas'] = outputs.new_empty((n_tiles, *outputs.shape[1:]))
+            page['canvas'][start:end] = outputs[offset:offset + end - start]
+            page['pending'] -= end - start
+            offset += end - start
+
+    def pop_finished(self):
+        """
+        Return the list of (key, page) of the completed pages, reassembled with merge_tiles.
+        """
+        finished = []
+        while self.pages:
+            key, page = next(iter(self.pages.items()))
+            if page['pending'] > 0:
+                break
+            self.pages.popitem(last=False)
+            finished.append((key, merge_tiles(page['canvas'], page['shape'], self.tile_size)))
+        return finished
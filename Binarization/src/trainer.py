@@ -5,11 +5,13 @@ import numpy as np
 
 from Binarization.schedule.schedule import Schedule
 from Binarization.model.NAFDPM import NAFDPM, EMA
+from Binarization.model.slimmable import set_width
 import utils.util as util
 from utils.metrics import calculate_metrics
 from utils.util import crop_concat, crop_concat_back
 from Binarization.schedule.diffusionSample import GaussianDiffusion
-from Binarization.schedule.dpm_solver_pytorch import NoiseScheduleVP, model_wrapper, DPM_Solver
+from Binarization.schedule.solver_plan import build_solver
+from Binarization.schedule.distillation import ProgressiveDistillation
 import torch
 import torch.optim as optim
 import torch.nn as nn
@@ -18,6 +20,7 @@ from torchvision.utils import save_image
 from tqdm import tqdm
 import copy
 from Binarization.src.sobel import Laplacian
+from Binarization.src.quantization import prepare_qat, convert, example_inputs, save_int8, float_state_dict
 import logging
 from collections import OrderedDict
 import pyiqa
@@ -39,7 +42,9 @@ class Trainer:
             n_channels      = config.MODEL_CHANNELS,
             middle_blk_num  = config.MIDDLE_BLOCKS, 
             enc_blk_nums    = config.ENC_BLOCKS, 
-            dec_blk_nums    = config.DEC_BLOCKS).to(self.device)
+            dec_blk_nums    = config.DEC_BLOCKS,
+            cond_encoder    = config.COND_ENCODER == 'True',
+            unshuffle       = config.PIXEL_UNSHUFFLE if config.PIXEL_UNSHUFFLE else 1).to(self.device)
 
         self.bestPSNR = 0
         self.bestFmeasure = 0
@@ -94,6 +99,22 @@ class Trainer:
         self.TEST_DENOISER_WEIGHT_PATH = config.TEST_DENOISER_WEIGHT_PATH
         self.DPM_SOLVER = config.DPM_SOLVER
         self.DPM_STEP = config.DPM_STEP
+        self.dpm_method = config.DPM_METHOD if config.DPM_METHOD else 'singlestep'
+        self.dpm_order = config.DPM_ORDER if config.DPM_ORDER else 1
+        self.dpm_skip_type = config.DPM_SKIP_TYPE if config.DPM_SKIP_TYPE else 'time_uniform'
+        self.dpm_thresholding = config.DPM_THRESHOLDING if config.DPM_THRESHOLDING else 'exact'
+        self.dpm_t_start = config.DPM_T_START if config.DPM_T_START else 1.
+        self.ddim_steps = config.DDIM_STEPS
+        self.ddim_skip_type = config.DDIM_SKIP_TYPE if config.DDIM_SKIP_TYPE else 'uniform'
+        #DPM SOLVER TIME GRID AND COEFFICIENTS, BUILT ONCE AND REUSED FOR EVERY BATCH
+        self.dpm_tolerance = [config.DPM_ATOL if config.DPM_ATOL else 0.0078, config.DPM_RTOL if config.DPM_RTOL else 0.05,
+                              config.DPM_MAX_NFE]
+        self.solver_plan = build_solver(self.schedule.get_betas(), self.DPM_STEP, method=self.dpm_method,
+                                        order=self.dpm_order, skip_type=self.dpm_skip_type,
+                                        thresholding_method=self.dpm_thresholding, atol=self.dpm_tolerance[0],
+                                        rtol=self.dpm_tolerance[1], max_nfe=self.dpm_tolerance[2],
+                                        t_start=self.dpm_t_start) \
+            if self.DPM_SOLVER == 'True' else None
         self.beta_loss = config.BETA_LOSS
         self.pre_ori = config.PRE_ORI
         self.high_low_freq = config.HIGH_LOW_FREQ
@@ -102,12 +123,24 @@ class Trainer:
         self.validate_every = config.VALIDATE_EVERY
         self.optimizer = optim.AdamW(self.network.parameters(), lr=self.LR, weight_decay=1e-4)
         self.val_iterations = config.VALIDATE_ITERATIONS
+        self.qat = config.QAT == 'True'
+        #SLIMMABLE TRAINING: EVERY WIDTH IS TRAINED AT EACH ITERATION, THE FULL WIDTH LAST
+        self.slim_widths = sorted(set(config.SLIM_WIDTHS if config.SLIM_WIDTHS else []) | {1.})
+        assert len(self.slim_widths) == 1 or not self.qat, "SLIM_WIDTHS is not supported with QAT"
+        for width_mult in self.slim_widths:
+            #RAISES IF A WIDTH DOES NOT GIVE INTEGER CHANNELS, THE NETWORK IS LEFT AT FULL WIDTH
+            set_width(self.network, width_mult)
+        self.distill_teacher_steps = config.DISTILL_TEACHER_STEPS
+        self.distill_steps = config.DISTILL_STEPS
+        self.distill_iterations = config.DISTILL_ITERATIONS
+        #SAMPLER OF THE DISTILLED DENOISER, SAVED WITH ITS CHECKPOINTS AND USED BY THE TESTER
+        self.distilled_sampler = None
 
  
         #DATASETS AND DATALOADERS
         from Binarization.data.docdata import DocData
-        if self.mode == 1:
-            dataset_train = DocData(self.path_train_img, self.path_train_gt, config.IMAGE_SIZE, self.mode)
+        if self.mode in [1, 5]:
+            dataset_train = DocData(self.path_train_img, self.path_train_gt, config.IMAGE_SIZE, 1)
             self.batch_size = config.BATCH_SIZE
             self.dataloader_train = DataLoader(dataset_train, batch_size=self.batch_size, shuffle=True, drop_last=False,
                                                num_workers=config.NUM_WORKERS)
@@ -132,7 +165,34 @@ class Trainer:
             self.bestFmeasure = checkpoint_denoiser['bestFmeasure']
             self.bestPFmeasure = checkpoint_denoiser['bestPFmeasure']
 
-            
+
+        if self.mode == 1 and self.qat:
+            #QUANTIZATION AWARE FINE-TUNING OF THE PRETRAINED FLOAT NETWORKS
+            if self.continue_training != 'True':
+                checkpoint_init = torch.load(self.pretrained_path_init_predictor)
+                checkpoint_denoiser = torch.load(self.pretrained_path_denoiser)
+                self.network.init_predictor.load_state_dict(checkpoint_init['model_state_dict'])
+                self.network.denoiser.load_state_dict(checkpoint_denoiser['model_state_dict'])
+            #THE PREPARED MODULES LIST THEIR PARAMETERS IN ANOTHER ORDER: KEEP THE FLOAT ONE FOR THE OPTIMIZER,
+            #SO ITS STATE IN THE CHECKPOINTS IS THE SAME WITH OR WITHOUT QAT
+            names = [name for name, _ in self.network.named_parameters()]
+            self.network.init_predictor = prepare_qat(self.network.init_predictor,
+                example_inputs('init_predictor', in_channels, self.image_size[0], self.device))
+            self.network.denoiser = prepare_qat(self.network.denoiser,
+                example_inputs('denoiser', out_channels, self.image_size[0], self.device))
+            self.diffusion = GaussianDiffusion(self.network.denoiser, config.TIMESTEPS, self.schedule).to(self.device)
+            parameters = dict(self.network.named_parameters())
+            self.optimizer = optim.AdamW([parameters[name] for name in names], lr=self.LR, weight_decay=1e-4)
+            if self.continue_training == 'True':
+                self.optimizer.load_state_dict(checkpoint_denoiser['optimizer_state_dict'])
+
+        if self.mode == 5:
+            #STEP DISTILLATION OF THE PRETRAINED DENOISER (THE INITIAL PREDICTOR IS KEPT AS IS)
+            checkpoint_init = torch.load(self.pretrained_path_init_predictor)
+            checkpoint_denoiser = torch.load(self.pretrained_path_denoiser)
+            self.network.init_predictor.load_state_dict(checkpoint_init['model_state_dict'])
+            self.network.denoiser.load_state_dict(checkpoint_denoiser['model_state_dict'])
+
         if self.mode == 1 and config.EMA == 'True':
             self.EMA = EMA(0.9999)
             self.ema_model = copy.deepcopy(self.network).to(self.device)
@@ -160,6 +220,7 @@ class Trainer:
                     "iterations": self.iteration_max,
                     "Native": self.native_resolution,
                     "DPM_Solver": self.DPM_SOLVER,
+                    "DPM_Method": [self.dpm_method, self.dpm_order, self.dpm_skip_type, self.DPM_STEP],
                     "Sampling_Steps": config.TIMESTEPS,
                     "Batch_Size": config.BATCH_SIZE,
                     "NUM_WORKERS": config.NUM_WORKERS,
@@ -214,11 +275,14 @@ class Trainer:
                 #REFINE RESIDUAL IMAGE USING DPM SOLVER OR DDIM
                 if self.DPM_SOLVER == 'True':   
                     #DPM SOLVER BRANCH
-                    sampled_imgs = dpm_solver(self.schedule.get_betas(), self.network.denoiser,
-                                             noisy_image, self.DPM_STEP, init_predict,model_kwargs={})
+                    sampled_imgs = self.solver_plan.sample(self.network.denoiser,
+                                                           self.solver_plan.initial_state(noisy_image), init_predict)
+                    if self.dpm_method == 'adaptive':
+                        self.logger.info(f"adaptive solver: {self.solver_plan.nfe} NFE for {name[0]}")
                 else:
                     #DDIM BRANCH
-                    sampled_imgs = self.diffusion(noisy_image.cuda(), init_predict, self.pre_ori)
+                    sampled_imgs = self.diffusion(noisy_image, init_predict, self.pre_ori, self.ddim_steps,
+                                                  self.ddim_skip_type)
                 
                 #COMPUTE FINAL IMAGES
                 final_imgs = (sampled_imgs + init_predict)
@@ -284,7 +348,7 @@ class Trainer:
                 self.bestPSNR=ave_psnr
                 to_save = {
                         'iteration': current_iteration,
-                        'model_state_dict': self.network.init_predictor.state_dict(),
+                        'model_state_dict': float_state_dict(self.network.init_predictor),
                         'optimizer_state_dict': self.optimizer.state_dict(),
                         'bestPSNR': self.bestPSNR,
                         'bestFmeasure': self.bestFmeasure if self.bestFmeasure > ave_fmeasure else ave_fmeasure,
@@ -295,7 +359,8 @@ class Trainer:
                 
                 to_save = {
                         'iteration': current_iteration,
-                        'model_state_dict': self.network.denoiser.state_dict(),
+                        'model_state_dict': float_state_dict(self.network.denoiser),
+                        'sampler': self.distilled_sampler,
                         'optimizer_state_dict': self.optimizer.state_dict(),
                         'bestPSNR': self.bestPSNR,
                         'bestFmeasure': self.bestFmeasure if self.bestFmeasure > ave_fmeasure else ave_fmeasure,
@@ -308,7 +373,7 @@ class Trainer:
                 self.bestFmeasure = ave_fmeasure
                 to_save = {
                         'iteration': current_iteration,
-                        'model_state_dict': self.network.init_predictor.state_dict(),
+                        'model_state_dict': float_state_dict(self.network.init_predictor),
                         'optimizer_state_dict': self.optimizer.state_dict(),
                         'bestPSNR': self.bestPSNR if self.bestPSNR > ave_psnr else ave_psnr,
                         'bestFmeasure': self.bestFmeasure,
@@ -318,7 +383,8 @@ class Trainer:
                     os.path.join(self.weight_save_path, f'BEST_Fmeasure_model_init.pth'))
                 to_save = {
                         'iteration': current_iteration,
-                        'model_state_dict': self.network.denoiser.state_dict(),
+                        'model_state_dict': float_state_dict(self.network.denoiser),
+                        'sampler': self.distilled_sampler,
                         'optimizer_state_dict': self.optimizer.state_dict(),
                         'bestPSNR': self.bestPSNR if self.bestPSNR > ave_psnr else ave_psnr,
                         'bestFmeasure': self.bestFmeasure,
@@ -331,7 +397,7 @@ class Trainer:
                 self.bestPFmeasure = ave_pfmeasure
                 to_save = {
                         'iteration': current_iteration,
-                        'model_state_dict': self.network.init_predictor.state_dict(),
+                        'model_state_dict': float_state_dict(self.network.init_predictor),
                         'optimizer_state_dict': self.optimizer.state_dict(),
                         'bestPSNR': self.bestPSNR if self.bestPSNR > ave_psnr else ave_psnr,
                         'bestFmeasure': self.bestFmeasure if self.bestFmeasure > ave_fmeasure else ave_fmeasure,
@@ -341,7 +407,8 @@ class Trainer:
                     os.path.join(self.weight_save_path, f'BEST_PFmeasure_model_init.pth'))
                 to_save = {
                         'iteration': current_iteration,
-                        'model_state_dict': self.network.denoiser.state_dict(),
+                        'model_state_dict': float_state_dict(self.network.denoiser),
+                        'sampler': self.distilled_sampler,
                         'optimizer_state_dict': self.optimizer.state_dict(),
                         'bestPSNR': self.bestPSNR if self.bestPSNR > ave_psnr else ave_psnr,
                         'bestFmeasure': self.bestFmeasure if self.bestFmeasure > ave_fmeasure else ave_fmeasure,
@@ -373,30 +440,33 @@ class Trainer:
                 #SELECT TIMESTEP VECTOR T
                 t = torch.randint(0, self.num_timesteps, (img.shape[0],)).long().to(self.device)
                 
-                #PASS IMAGES AND T THROUGH THE NETWORK
-                init_predict, noise_pred, noisy_image, noise_ref = self.network(gt.to(self.device), img.to(self.device),
-                                                                                t, self.diffusion)
-                low_freq_loss = None
-                low_high_loss = None
+                #ONE FORWARD/BACKWARD PER WIDTH OF SLIM_WIDTHS, THE GRADIENTS ACCUMULATE IN THE SHARED WEIGHTS
+                for width_mult in self.slim_widths:
+                    set_width(self.network, width_mult)
+                    #PASS IMAGES AND T THROUGH THE NETWORK
+                    init_predict, noise_pred, noisy_image, noise_ref = self.network(gt.to(self.device), img.to(self.device),
+                                                                                    t, self.diffusion)
+                    low_freq_loss = None
+                    low_high_loss = None
 
-                if self.pre_ori == 'True':
-                    if self.high_low_freq == 'True':
-                        residual_high = self.high_filter(gt.to(self.device) - init_predict)
-                        ddpm_loss = 2*self.loss(self.high_filter(noise_pred), residual_high) + self.loss(noise_pred, gt.to(self.device) - init_predict)
+                    if self.pre_ori == 'True':
+                        if self.high_low_freq == 'True':
+                            residual_high = self.high_filter(gt.to(self.device) - init_predict)
+                            ddpm_loss = 2*self.loss(self.high_filter(noise_pred), residual_high) + self.loss(noise_pred, gt.to(self.device) - init_predict)
+                        else:
+                            ddpm_loss = self.loss(noise_pred, gt.to(self.device) - init_predict)
                     else:
-                        ddpm_loss = self.loss(noise_pred, gt.to(self.device) - init_predict)
-                else:
-                    ddpm_loss = self.loss(noise_pred, noise_ref.to(self.device))
+                        ddpm_loss = self.loss(noise_pred, noise_ref.to(self.device))
                     
-                if self.high_low_freq == 'True':
-                    low_high_loss = self.loss(init_predict, gt.to(self.device))
-                    low_freq_loss = self.loss(init_predict - self.high_filter(init_predict), gt.to(self.device) - self.high_filter(gt.to(self.device)))
-                    pixel_loss = low_high_loss + 2*low_freq_loss
-                else:
-                    pixel_loss = self.loss(init_predict, gt.to(self.device))
+                    if self.high_low_freq == 'True':
+                        low_high_loss = self.loss(init_predict, gt.to(self.device))
+                        low_freq_loss = self.loss(init_predict - self.high_filter(init_predict), gt.to(self.device) - self.high_filter(gt.to(self.device)))
+                        pixel_loss = low_high_loss + 2*low_freq_loss
+                    else:
+                        pixel_loss = self.loss(init_predict, gt.to(self.device))
 
-                loss = ddpm_loss + self.beta_loss * pixel_loss / self.num_timesteps
-                loss.backward()
+                    loss = ddpm_loss + self.beta_loss * pixel_loss / self.num_timesteps
+                    loss.backward()
                 optimizer.step()
                 
                 if self.high_low_freq == 'True':
@@ -435,7 +505,7 @@ class Trainer:
                         os.makedirs(self.weight_save_path)
                     to_save = {
                         'iteration': iteration,
-                        'model_state_dict': self.network.init_predictor.state_dict(),
+                        'model_state_dict': float_state_dict(self.network.init_predictor),
                         'optimizer_state_dict': self.optimizer.state_dict(),
                         'bestPSNR': self.bestPSNR ,
                         'bestFmeasure': self.bestFmeasure ,
@@ -445,7 +515,8 @@ class Trainer:
                                os.path.join(self.weight_save_path, f'model_init_{iteration}.pth'))
                     to_save = {
                         'iteration': iteration,
-                        'model_state_dict': self.network.denoiser.state_dict(),
+                        'model_state_dict': float_state_dict(self.network.denoiser),
+                        'sampler': self.distilled_sampler,
                         'optimizer_state_dict': self.optimizer.state_dict(),
                         'bestPSNR': self.bestPSNR ,
                         'bestFmeasure': self.bestFmeasure ,
@@ -453,55 +524,80 @@ class Trainer:
                     }
                     torch.save(to_save,
                                os.path.join(self.weight_save_path, f'model_denoiser_{iteration}.pth'))
-
-
-
-def dpm_solver(betas, model, x_t, steps, condition, model_kwargs):
-    # You need to firstly define your model and the extra inputs of your model,
-    # And initialize an `x_T` from the standard normal distribution.
-    # `model` has the format: model(x_t, t_input, **model_kwargs).
-    # If your model has no extra inputs, just let model_kwargs = {}.
-
-    # If you use discrete-time DPMs, you need to further define the
-    # beta arrays for the noise schedule.
-
-    # model = ....
-    # model_kwargs = {...}
-    # x_T = ...
-    # betas = ....
-
-    # 1. Define the noise schedule.
-    noise_schedule = NoiseScheduleVP(schedule='discrete', betas=betas)
-
-    # 2. Convert your discrete-time `model` to the continuous-time
-    # noise prediction model. Here is an example for a diffusion model
-    # `model` with the noise prediction type ("noise") .
-    model_fn = model_wrapper(
-        model,
-        noise_schedule,
-        model_type="x_start",  # or "x_start" or "v" or "score"
-        model_kwargs=model_kwargs,
-        guidance_type="classifier-free",
-        condition=condition
-    )
-
-    # 3. Define dpm-solver and sample by singlestep DPM-Solver.
-    # (We recommend singlestep DPM-Solver for unconditional sampling)
-    # You can adjust the `steps` to balance the computation
-    # costs and the sample quality.
-    dpm_solver_instance = DPM_Solver(model_fn, noise_schedule, algorithm_type="dpmsolver++",
-                                     correcting_x0_fn="dynamic_thresholding")
-    # Can also try
-    # dpm_solver = DPM_Solver(model_fn, noise_schedule, algorithm_type="dpmsolver++")
-
-    # You can use steps = 10, 12, 15, 20, 25, 50, 100.
-    # Empirically, we find that steps in [10, 20] can generate quite good samples.
-    # And steps = 20 can almost converge.
-    x_sample = dpm_solver_instance.sample(
-        x_t,
-        steps=steps,
-        order=1,
-        skip_type="time_uniform",
-        method="singlestep",
-    )
-    return x_sample
+                    if self.qat:
+                        #THE CHECKPOINTS ABOVE HOLD THE FLOAT WEIGHTS (NO FAKE QUANTIZATION), ONLY int8_{iteration}
+                        #HOLDS THE INT8 NETWORKS, LOADED BY THE TESTER WITH INT8 : 'True' AND INT8_PATH
+                        save_int8(convert(self.network.init_predictor), convert(self.network.denoiser),
+                                  os.path.join(self.weight_save_path, f'int8_{iteration}'))
+
+    # STEP DISTILLATION FUNCTION
+    def distill(self):
+        """
+        Progressive distillation of the pretrained denoiser: each round halves the number of DPM solver
+        steps, from DISTILL_TEACHER_STEPS down to DISTILL_STEPS, training the student for DISTILL_ITERATIONS
+        iterations. The student of each round is saved as model_denoiser_distilled_{steps}.pth, with the
+        sampler the Tester has to use for it.
+        """
+        ratio = self.distill_teacher_steps // self.distill_steps
+        assert self.distill_teacher_steps % self.distill_steps == 0 and ratio & (ratio - 1) == 0, \
+            "DISTILL_TEACHER_STEPS must be DISTILL_STEPS times a power of two"
+        self.network.init_predictor.eval()
+        for param in self.network.init_predictor.parameters():
+            param.requires_grad_(False)
+
+        iteration = 0
+        steps = self.distill_teacher_steps
+        while steps > self.distill_steps:
+            student_steps = steps // 2
+            teacher = copy.deepcopy(self.network.denoiser).eval()
+            for param in teacher.parameters():
+                param.requires_grad_(False)
+            distillation = ProgressiveDistillation(self.schedule.get_betas(), student_steps, self.dpm_thresholding)
+            self.optimizer = optim.AdamW(self.network.denoiser.parameters(), lr=self.LR, weight_decay=1e-4)
+
+            round_iteration = 0
+            while round_iteration < self.distill_iterations:
+                tq = tqdm(self.dataloader_train)
+                for img, gt, _ in tq:
+                    tq.set_description(f'Distillation {steps} -> {student_steps} steps. '
+                                       f'Iteration {round_iteration} / {self.distill_iterations}')
+                    self.network.denoiser.train()
+                    self.optimizer.zero_grad()
+
+                    #RESIDUAL TARGETS OF THE FROZEN INITIAL PREDICTOR
+                    with torch.no_grad():
+                        init_predict = self.network.init_predictor(img.to(self.device))
+                    x_t, t_input, target = distillation.training_pair(teacher, gt.to(self.device) - init_predict,
+                                                                      init_predict)
+                    loss = self.loss(self.network.denoiser(x_t, t_input, init_predict), target)
+                    loss.backward()
+                    self.optimizer.step()
+                    tq.set_postfix(loss=loss.item())
+
+                    iteration += 1
+                    round_iteration += 1
+                    if self.wandb and iteration % 1000 == 0:
+                        wandb.log({'Distillation_Loss': loss}, step=iteration)
+                    if round_iteration >= self.distill_iterations:
+                        break
+
+            #THE STUDENT IS SAMPLED WITH student_steps FIRST ORDER STEPS ON THE time_uniform GRID
+            self.distilled_sampler = {'steps': student_steps, 'method': 'singlestep', 'order': 1,
+                                      'skip_type': 'time_uniform'}
+            self.solver_plan = build_solver(self.schedule.get_betas(), student_steps,
+                                            thresholding_method=self.dpm_thresholding)
+            self.diffusion = GaussianDiffusion(self.network.denoiser, self.num_timesteps, self.schedule).to(self.device)
+            if not os.path.exists(self.weight_save_path):
+                os.makedirs(self.weight_save_path)
+            for name, module in (('init', self.network.init_predictor), ('denoiser', self.network.denoiser)):
+                to_save = {
+                    'iteration': iteration,
+                    'model_state_dict': module.state_dict(),
+                    'optimizer_state_dict': self.optimizer.state_dict(),
+                    'sampler': self.distilled_sampler,
+                }
+                torch.save(to_save, os.path.join(self.weight_save_path, f'model_{name}_distilled_{student_steps}.pth'))
+            self.logger.info(f"Distilled denoiser for {student_steps} steps saved to {self.weight_save_path}")
+            if self.DPM_SOLVER == 'True':
+                self.validate(iteration)
+            steps = student_steps
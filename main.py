@@ -35,5 +35,37 @@ def main():
         print('Training complete')
         print("--------------------------")
 
+    elif mode == 5:
+        print("--------------------------")
+        print('Start Distillation')
+        print("--------------------------")
+
+        trainer = Trainer(config)
+        trainer.distill()
+
+        print("--------------------------")
+        print('Distillation complete')
+        print("--------------------------")
+
+    elif mode == 3:
+        print("--------------------------")
+        print('Start Inference')
+        print("--------------------------")
+
+        tester = Tester(config)
+        tester.infer()
+
+        print("--------------------------")
+        print('Inference complete')
+        print("--------------------------")
+
+    elif mode == 4:
+        print("--------------------------")
+        print('Start Server')
+        print("--------------------------")
+
+        tester = Tester(config)
+        tester.serve()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
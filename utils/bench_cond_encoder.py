@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Binarization.model.ConditionalNAFNET import ConditionalNAFNet
+from Binarization.schedule.schedule import Schedule
+from Binarization.schedule.solver_plan import SolverPlan
+
+
+def timeit(fn, repeat, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return 1000. * (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sampling time of the concatenation denoiser and of the '
+                                                 'condition encoder variant (COND_ENCODER) per DPM_STEP.')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--size', type=int, default=256, help='tile size')
+    parser.add_argument('--width', type=int, default=32)
+    parser.add_argument('--enc_blocks', type=int, nargs='+', default=[1, 1, 1, 1])
+    parser.add_argument('--steps', type=int, nargs='+', default=[1, 2, 5, 10, 20])
+    parser.add_argument('--timesteps', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    #RANDOM WEIGHTS: ONLY THE COST IS MEASURED
+    networks = {cond_encoder: ConditionalNAFNet(inp_channel=2, out_channel=1, width=args.width, middle_blk_num=1,
+                                                enc_blk_nums=args.enc_blocks, dec_blk_nums=[1] * len(args.enc_blocks),
+                                                cond_encoder=cond_encoder).to(device).eval()
+                for cond_encoder in (False, True)}
+    betas = Schedule('linear', args.timesteps).get_betas()
+    x = torch.randn(args.batch_size, 1, args.size, args.size, device=device)
+    cond = torch.rand_like(x)
+    print('{:>7}{:>13}{:>16}{:>13}{:>16}{:>10}'.format('steps', 'concat (ms)', 'per step (ms)', 'encoder (ms)',
+                                                       'per step (ms)', 'speedup'))
+    for steps in args.steps:
+        plan = SolverPlan(betas, steps)
+        #A NEW cond TENSOR PER SAMPLE, SO THE CONDITION IS ENCODED ONCE PER SAMPLE AS IN THE TESTER
+        concat_ms, encoder_ms = [timeit(lambda: plan.sample(networks[cond_encoder], x, cond.clone()), args.repeat, device)
+                                 for cond_encoder in (False, True)]
+        print('{:>7}{:>13.1f}{:>16.1f}{:>13.1f}{:>16.1f}{:>9.2f}x'.format(
+            steps, concat_ms, concat_ms / plan.nfe, encoder_ms, encoder_ms / plan.nfe, concat_ms / encoder_ms))
@@ -0,0 +1,46 @@
+import argparse
+import itertools
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import load_config
+from Binarization.src.tester import Tester
+from utils.int8_report import evaluate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DIBCO metrics and time of the denoiser feature cache (deep features '
+                                                 'reused between solver steps) on a test set.')
+    parser.add_argument('--config', type=str, default='Binarization/fmeasure.yml', help='test configuration (MODE 0)')
+    parser.add_argument('--r_weights', type=str, default='./dataset/validation/r_weights')
+    parser.add_argument('--p_weights', type=str, default='./dataset/validation/p_weights')
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 2, 3],
+                        help='shallow encoder/decoder levels recomputed on the cached calls')
+    parser.add_argument('--schedules', type=int, nargs='+', default=[2, 3],
+                        help='a full denoiser call every N calls of a sample')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    config._dict['MODE'] = 0
+    tester = Tester(config)
+    tester.load_checkpoints()
+    denoiser = tester.network.denoiser
+
+    print('{:>7}{:>10}{:>9}{:>11}{:>11}{:>9}{:>9}{:>10}{:>10}'.format(
+        'depth', 'schedule', 'reused', 'FMeasure', 'PFMeasure', 'PSNR', 'DRD', 'dFM', 'Time (s)'))
+    reference = None
+    for depth, schedule in [(0, 1)] + list(itertools.product(args.depths, args.schedules)):
+        #depth 0: NO FEATURE CACHE, THE REFERENCE OF dFM
+        if depth == 0:
+            denoiser.disable_feature_cache()
+        else:
+            denoiser.enable_feature_cache(depth, schedule)
+        tester.feature_cache = [depth, schedule]
+        tester.nfe_stats.update(batches=0, nfe=0, tiles=0, tile_evals=0, reused=0)
+        metrics, elapsed = evaluate(tester, args.r_weights, args.p_weights)
+        reused = tester.nfe_stats['reused'] / max(tester.nfe_stats['nfe'], 1)
+        reference = metrics[0] if reference is None else reference
+        print('{:>7}{:>10}{:>8.0f}%{:>11.4f}{:>11.4f}{:>9.4f}{:>9.4f}{:>+10.4f}{:>10.2f}'.format(
+            depth, schedule, 100. * reused, *metrics, metrics[0] - reference, elapsed))
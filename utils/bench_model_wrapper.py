@@ -0,0 +1,58 @@
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Binarization.schedule.schedule import Schedule
+from Binarization.schedule.dpm_solver_pytorch import NoiseScheduleVP, model_wrapper
+
+
+def loop_x_start(noise_schedule, x, output, t_continuous):
+    #PREVIOUS PER IMAGE CONVERSION OF THE x_start BRANCH, KEPT AS REFERENCE
+    alpha_t, sigma_t = noise_schedule.marginal_alpha(t_continuous), noise_schedule.marginal_std(t_continuous)
+    for i in range(x.shape[0]):
+        temp_result = (x[i] - torch.unsqueeze(output[i], 0) * alpha_t[i]) / torch.unsqueeze(sigma_t[i], 0)
+        result = temp_result if i == 0 else torch.cat((result, temp_result), dim=0)
+    return result
+
+
+def timeit(fn, repeat, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return 1000. * (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per step overhead of the model_wrapper x_start conversion.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 16, 50, 100, 200])
+    parser.add_argument('--size', type=int, default=256, help='tile size')
+    parser.add_argument('--timesteps', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    noise_schedule = NoiseScheduleVP(schedule='discrete', betas=Schedule('linear', args.timesteps).get_betas())
+    print('{:>8}{:>14}{:>14}{:>10}{:>12}'.format('batch', 'loop (ms)', 'batched (ms)', 'speedup', 'max diff'))
+    for batch in args.batch_sizes:
+        x = torch.randn(batch, 1, args.size, args.size, device=device)
+        cond = torch.rand_like(x)
+        output = torch.rand_like(x)
+        t = torch.full((batch,), 0.5, device=device)
+        #THE MODEL RETURNS A PRECOMPUTED OUTPUT, SO ONLY THE CONVERSION IS MEASURED
+        model_fn = model_wrapper(lambda x, t, cond: output, noise_schedule, model_type="x_start",
+                                 model_kwargs={}, guidance_type="classifier-free", condition=cond,
+                                 unconditional_condition=None)
+        loop_ms = timeit(lambda: loop_x_start(noise_schedule, x, output, t), args.repeat, device)
+        batched_ms = timeit(lambda: model_fn(x, t), args.repeat, device)
+        diff = (loop_x_start(noise_schedule, x, output, t) - model_fn(x, t)).abs().max().item()
+        print('{:>8}{:>14.3f}{:>14.3f}{:>9.1f}x{:>12.2e}'.format(batch, loop_ms, batched_ms, loop_ms / batched_ms, diff))
@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import load_config
+from Binarization.src.tester import Tester
+from utils.int8_report import evaluate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DIBCO metrics and time of denoiser variants (e.g. PIXEL_UNSHUFFLE, '
+                                                 'COND_ENCODER), each test configuration with its own trained weights. '
+                                                 'CPU numbers: run with CUDA_VISIBLE_DEVICES="".')
+    parser.add_argument('--configs', type=str, nargs='+', required=True,
+                        help='test configurations (MODE 0) on the same test set, the first one is the reference')
+    parser.add_argument('--r_weights', type=str, default='./dataset/validation/r_weights')
+    parser.add_argument('--p_weights', type=str, default='./dataset/validation/p_weights')
+    parser.add_argument('--threads', type=int, default=None, help='torch threads (CPU)')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = []
+    for path in args.configs:
+        config = load_config(path)
+        config._dict['MODE'] = 0
+        tester = Tester(config)
+        tester.load_checkpoints()
+        metrics, elapsed = evaluate(tester, args.r_weights, args.p_weights)
+        results.append((path, config.PIXEL_UNSHUFFLE or 1, config.COND_ENCODER == 'True', metrics, elapsed))
+
+    print('{:<40}{:>10}{:>9}{:>11}{:>11}{:>9}{:>9}{:>10}{:>10}{:>9}'.format(
+        'config', 'unshuffle', 'encoder', 'FMeasure', 'PFMeasure', 'PSNR', 'DRD', 'dFM', 'Time (s)', 'speedup'))
+    reference = results[0]
+    for path, unshuffle, cond_encoder, metrics, elapsed in results:
+        print('{:<40}{:>10}{:>9}{:>11.4f}{:>11.4f}{:>9.4f}{:>9.4f}{:>+10.4f}{:>10.2f}{:>8.2f}x'.format(
+            os.path.basename(path), unshuffle, str(cond_encoder), *metrics, metrics[0] - reference[3][0], elapsed,
+            reference[4] / elapsed))
@@ -0,0 +1,66 @@
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import load_config
+from Binarization.model.NAFDPM import NAFDPM
+from Binarization.src.onnx_backend import export_nafdpm, OrtModule, INIT_PREDICTOR_FILE, DENOISER_FILE
+
+
+def build_network(config, local):
+    #mode=0 BUILDS THE Local_Base (TLSC) VARIANTS, mode=1 THE PLAIN NAFNet/ConditionalNAFNet
+    network = NAFDPM(input_channels=config.CHANNEL_X,
+                     output_channels=config.CHANNEL_Y,
+                     n_channels=config.MODEL_CHANNELS,
+                     middle_blk_num=config.MIDDLE_BLOCKS,
+                     enc_blk_nums=config.ENC_BLOCKS,
+                     dec_blk_nums=config.DEC_BLOCKS,
+                     mode=0 if local else 1,
+                     cond_encoder=config.COND_ENCODER == 'True',
+                     unshuffle=config.PIXEL_UNSHUFFLE if config.PIXEL_UNSHUFFLE else 1)
+    checkpoint_init = torch.load(config.TEST_INITIAL_PREDICTOR_WEIGHT_PATH, map_location='cpu', weights_only=False)
+    checkpoint_denoiser = torch.load(config.TEST_DENOISER_WEIGHT_PATH, map_location='cpu', weights_only=False)
+    network.init_predictor.load_state_dict(checkpoint_init['model_state_dict'])
+    network.denoiser.load_state_dict(checkpoint_denoiser['model_state_dict'])
+    return network.eval()
+
+
+def check(network, output_path, config, size):
+    """
+    Compare the ONNX Runtime outputs with the PyTorch ones on random inputs.
+    """
+    img = torch.rand(3, config.CHANNEL_X, size, size)
+    x = torch.randn(3, config.CHANNEL_Y, size, size)
+    time = torch.tensor([1., 250., 999.])
+    with torch.no_grad():
+        init_predict = network.init_predictor(img)
+        output = network.denoiser(x, time, init_predict)
+    ort_init_predictor = OrtModule(os.path.join(output_path, INIT_PREDICTOR_FILE), providers=['CPUExecutionProvider'])
+    ort_denoiser = OrtModule(os.path.join(output_path, DENOISER_FILE), providers=['CPUExecutionProvider'])
+    print('init predictor max abs diff: {:.2e}'.format((ort_init_predictor(img) - init_predict).abs().max().item()))
+    print('denoiser max abs diff: {:.2e}'.format((ort_denoiser(x, time, init_predict) - output).abs().max().item()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the initial predictor and the denoiser of NAF-DPM to ONNX.')
+    parser.add_argument('--config', type=str, default='Binarization/fmeasure.yml',
+                        help='configuration file, TEST_*_WEIGHT_PATH are the exported checkpoints')
+    parser.add_argument('--output', type=str, default=None, help='output directory (default ONNX_PATH of the config)')
+    parser.add_argument('--size', type=int, default=None, help='input size (default TILE_SIZE of the config)')
+    parser.add_argument('--local', action='store_true', help='export the Local_Base (TLSC) variants')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--check', action='store_true', help='compare ONNX Runtime and PyTorch outputs')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    output_path = args.output if args.output else config.ONNX_PATH
+    size = args.size if args.size else (config.TILE_SIZE if config.TILE_SIZE else 256)
+    network = build_network(config, args.local)
+    export_nafdpm(network, output_path, config.CHANNEL_X, config.CHANNEL_Y, size, args.opset)
+    print('Exported to {}'.format(output_path))
+    if args.check:
+        check(network, output_path, config, size)
@@ -0,0 +1,85 @@
+import argparse
+import copy
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import load_config
+from Binarization.schedule.diffusionSample import GaussianDiffusion
+from Binarization.src.tester import Tester
+from Binarization.src.tiling import split_tiles, merge_tiles
+from utils.metrics import calculate_metrics
+
+
+def use_networks(tester, init_predictor, denoiser):
+    tester.network.init_predictor = init_predictor
+    tester.network.denoiser = denoiser
+    tester.diffusion = GaussianDiffusion(denoiser, tester.num_timesteps, tester.schedule).to(tester.device)
+
+
+def evaluate(tester, r_weights, p_weights):
+    """
+    Binarize the test pages of `tester` and compute the DIBCO metrics with calculate_metrics.
+    Returns (mean [fmeasure, pfmeasure, psnr, drd], seconds spent in the networks).
+    """
+    results = []
+    elapsed = 0.
+    with torch.no_grad():
+        for index, (img, gt, name) in enumerate(tester.dataloader_test):
+            #SAME NOISE FOR THE FLOAT AND THE INT8 NETWORKS
+            torch.manual_seed(index)
+            start = time.perf_counter()
+            if tester.native_resolution == 'True':
+                final_imgs = merge_tiles(tester.restore(split_tiles(img, tester.tile_size)).cpu(), img.shape,
+                                         tester.tile_size)
+            else:
+                final_imgs = tester.restore(img).cpu()
+            elapsed += time.perf_counter() - start
+
+            final_imgs = torch.clamp(final_imgs, 0, 1)
+            height, width = final_imgs.shape[-2:]
+            name_str, _ = os.path.splitext(name[0])
+            r_weight = np.loadtxt(os.path.join(r_weights, name_str + "_GT_RWeights.dat"), dtype=np.float64).flatten()[
+                       :height * width].reshape((height, width))
+            p_weight = np.loadtxt(os.path.join(p_weights, name_str + "_GT_PWeights.dat"), dtype=np.float64).flatten()[
+                       :height * width].reshape((height, width))
+            _, im = cv2.threshold(final_imgs[0, 0].numpy(), 0.5, 1, cv2.THRESH_BINARY)
+            _, im_gt = cv2.threshold(gt[0, 0].numpy(), 0.5, 1, cv2.THRESH_BINARY)
+            results.append(calculate_metrics(im, im_gt, r_weight, p_weight))
+    return np.mean(np.array(results, dtype=np.float64), axis=0), elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the float and the int8 NAF-DPM networks on a DIBCO test set.')
+    parser.add_argument('--config', type=str, default='Binarization/fmeasure.yml',
+                        help='test configuration (MODE 0), INT8_PATH and CALIBRATION_* are used for the int8 networks')
+    parser.add_argument('--r_weights', type=str, default='./dataset/validation/r_weights')
+    parser.add_argument('--p_weights', type=str, default='./dataset/validation/p_weights')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    config._dict['MODE'] = 0
+    config._dict['INT8'] = 'False'
+    tester = Tester(config)
+    tester.device = torch.device('cpu')
+    tester.network.cpu().eval()
+    tester.load_checkpoints()
+    float_networks = (copy.deepcopy(tester.network.init_predictor), copy.deepcopy(tester.network.denoiser))
+    tester.quantize_networks()
+    int8_networks = (tester.network.init_predictor, tester.network.denoiser)
+
+    use_networks(tester, *float_networks)
+    float_metrics, float_time = evaluate(tester, args.r_weights, args.p_weights)
+    use_networks(tester, *int8_networks)
+    int8_metrics, int8_time = evaluate(tester, args.r_weights, args.p_weights)
+
+    print('{:<12}{:>12}{:>12}{:>12}'.format('', 'float', 'int8', 'delta'))
+    for metric, f, q in zip(['FMeasure', 'PFMeasure', 'PSNR', 'DRD'], float_metrics, int8_metrics):
+        print('{:<12}{:>12.4f}{:>12.4f}{:>+12.4f}'.format(metric, f, q, q - f))
+    print('{:<12}{:>12.2f}{:>12.2f}{:>11.2f}x'.format('Time (s)', float_time, int8_time, float_time / max(int8_time, 1e-9)))
@@ -0,0 +1,136 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import load_config
+from Binarization.schedule.solver_plan import SolverPlan, build_solver, save_schedule
+from Binarization.src.tester import Tester
+from utils.int8_report import evaluate
+
+METRICS = ['fmeasure', 'pfmeasure', 'psnr', 'drd']
+
+
+def uniform_indices(steps, total_N):
+    #time_uniform GRID ROUNDED TO THE DISCRETE TIMESTEPS: t = k / total_N, k FROM total_N DOWN TO 1
+    return [round(total_N - (total_N - 1) * i / steps) for i in range(steps + 1)]
+
+
+def valid(indices, total_N):
+    return indices[0] <= total_N and indices[-1] == 1 and all(s > t for s, t in zip(indices, indices[1:]))
+
+
+class ScheduleSearch:
+    """
+    Greedy coordinate search of the solver time grid on the test set of `tester`: every point of the grid
+    (the first one too if `search_start`) is moved by +-each of `moves` discrete timesteps, and a move is
+    kept when it improves the objective. Rounds are repeated until none improves it.
+    Each grid is evaluated with the same noise (see evaluate), and evaluated once.
+    """
+
+    def __init__(self, tester, r_weights, p_weights, method, order, objective, moves, search_start=False):
+        self.tester = tester
+        self.r_weights = r_weights
+        self.p_weights = p_weights
+        self.method = method
+        self.order = order
+        self.objective = objective
+        self.moves = moves
+        self.search_start = search_start
+        self.total_N = tester.num_timesteps
+        self.evaluated = {}
+
+    def metrics(self, indices):
+        key = tuple(indices)
+        if key not in self.evaluated:
+            self.tester.solver_plan = SolverPlan(self.tester.schedule.get_betas(), None, order=self.order,
+                                                 skip_type=[k / self.total_N for k in indices], method=self.method,
+                                                 thresholding_method=self.tester.dpm_thresholding)
+            self.evaluated[key], _ = evaluate(self.tester, self.r_weights, self.p_weights)
+        return self.evaluated[key]
+
+    def score(self, indices):
+        metrics = self.metrics(indices)
+        #HIGHER IS BETTER
+        return -metrics[3] if self.objective == 'drd' else metrics[METRICS.index(self.objective)]
+
+    def search(self, indices, rounds):
+        best, best_score = list(indices), self.score(indices)
+        for _ in range(rounds):
+            improved = False
+            for position in range(0 if self.search_start else 1, len(best) - 1):
+                for move in self.moves:
+                    for candidate in ([*best[:position], best[position] + move, *best[position + 1:]],
+                                      [*best[:position], best[position] - move, *best[position + 1:]]):
+                        if not valid(candidate, self.total_N):
+                            continue
+                        score = self.score(candidate)
+                        if score > best_score:
+                            best, best_score, improved = candidate, score, True
+            if not improved:
+                break
+        return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search the DPM solver time grid of a few step sampler on a '
+                                                 'validation set, and save it for DPM_SCHEDULE_PATH.')
+    parser.add_argument('--config', type=str, default='Binarization/fmeasure.yml',
+                        help='test configuration (MODE 0), TEST_PATH_IMG/TEST_PATH_GT being the validation set')
+    parser.add_argument('--r_weights', type=str, default='./dataset/validation/r_weights')
+    parser.add_argument('--p_weights', type=str, default='./dataset/validation/p_weights')
+    parser.add_argument('--method', type=str, default='multistep', choices=['singlestep', 'multistep', 'unipc'])
+    parser.add_argument('--order', type=int, default=2)
+    parser.add_argument('--nfe', type=int, nargs='+', default=[3, 4, 5, 6],
+                        help='denoiser evaluations per sample (multiples of --order for singlestep)')
+    parser.add_argument('--objective', type=str, default='fmeasure', choices=METRICS)
+    parser.add_argument('--moves', type=int, nargs='+', default=None,
+                        help='moves in discrete timesteps (default TIMESTEPS / 4, / 10, / 25 and / 100)')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--search_start', action='store_true',
+                        help='also move the first point (start from the noised zero residual, see DPM_T_START)')
+    parser.add_argument('--reference', type=str, nargs=3, default=['singlestep', '1', '10'],
+                        metavar=('METHOD', 'ORDER', 'STEPS'), help='solver the searched grids are compared with')
+    parser.add_argument('--output', type=str, default='./schedules')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    config._dict['MODE'] = 0
+    config._dict['DPM_SOLVER'] = 'True'
+    config._dict['DPM_SCHEDULE_PATH'] = None
+    tester = Tester(config)
+    tester.load_checkpoints()
+    total_N = tester.num_timesteps
+    moves = args.moves if args.moves else sorted({max(1, total_N // d) for d in (4, 10, 25, 100)}, reverse=True)
+    os.makedirs(args.output, exist_ok=True)
+
+    tester.solver_plan = build_solver(tester.schedule.get_betas(), int(args.reference[2]), method=args.reference[0],
+                                      order=int(args.reference[1]), skip_type=tester.dpm_skip_type,
+                                      thresholding_method=tester.dpm_thresholding)
+    reference, _ = evaluate(tester, args.r_weights, args.p_weights)
+    print('reference {} order {} ({} NFE): '.format(args.reference[0], args.reference[1], tester.solver_plan.nfe)
+          + ', '.join(f'{name} {value:.4f}' for name, value in zip(METRICS, reference)))
+
+    print('{:>5}{:>11}{:>11}{:>9}{:>9}{:>10}{:>10}{:>8}  {}'.format(
+        'NFE', 'FMeasure', 'PFMeasure', 'PSNR', 'DRD', 'dFM', 'uniform', 'evals', 'timesteps'))
+    for nfe in args.nfe:
+        #SINGLESTEP: ONE STEP OF args.order EVALUATIONS PER INTERVAL, SO nfe MUST BE A MULTIPLE OF THE ORDER
+        per_step = args.order if args.method == 'singlestep' else 1
+        steps = nfe // per_step
+        if nfe % per_step != 0:
+            print(f'{nfe} NFE skipped: not a multiple of the {per_step} evaluations of a singlestep step')
+            continue
+        if steps < 1 or steps >= total_N or (args.method != 'singlestep' and steps < args.order):
+            continue
+        search = ScheduleSearch(tester, args.r_weights, args.p_weights, args.method, args.order, args.objective, moves,
+                                args.search_start)
+        start = uniform_indices(steps, total_N)
+        best = search.search(start, args.rounds)
+        metrics = search.metrics(best)
+        #dFM: AGAINST THE REFERENCE, uniform: FMEASURE OF THE time_uniform GRID THE SEARCH STARTED FROM
+        print('{:>5}{:>11.4f}{:>11.4f}{:>9.4f}{:>9.4f}{:>+10.4f}{:>10.4f}{:>8}  {}'.format(
+            steps * per_step, *metrics, metrics[0] - reference[0], search.metrics(start)[0], len(search.evaluated), best))
+        save_schedule(os.path.join(args.output, f'schedule_{args.method}_{args.order}_{nfe}nfe.json'),
+                      [k / total_N for k in best], args.method, args.order, total_N,
+                      metrics=dict(zip(METRICS, metrics.tolist()), reference=dict(zip(METRICS, reference.tolist()))))
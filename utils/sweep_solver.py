@@ -0,0 +1,61 @@
+import argparse
+import itertools
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import load_config
+from Binarization.schedule.solver_plan import build_solver
+from Binarization.src.tester import Tester
+from utils.int8_report import evaluate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DIBCO metrics per number of function evaluations (NFE) of the '
+                                                 'DPM solvers on a test set.')
+    parser.add_argument('--config', type=str, default='Binarization/fmeasure.yml', help='test configuration (MODE 0)')
+    parser.add_argument('--r_weights', type=str, default='./dataset/validation/r_weights')
+    parser.add_argument('--p_weights', type=str, default='./dataset/validation/p_weights')
+    parser.add_argument('--methods', type=str, nargs='+', default=['singlestep', 'multistep', 'unipc', 'adaptive'])
+    parser.add_argument('--orders', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--steps', type=int, nargs='+', default=[4, 5, 6, 8, 10])
+    parser.add_argument('--skip_type', type=str, default=None, help='time grid (default DPM_SKIP_TYPE of the config)')
+    parser.add_argument('--max_nfe', type=int, nargs='+', default=[6, 10, 20],
+                        help="NFE budgets of the 'adaptive' method (with DPM_ATOL/DPM_RTOL of the config), "
+                             "--steps is not used")
+    parser.add_argument('--t_start', type=float, nargs='+', default=[1.],
+                        help='start times of the solvers in (0, 1], < 1 starts from the noised zero residual')
+    parser.add_argument('--reference', type=str, nargs=3, default=['singlestep', '1', '10'],
+                        metavar=('METHOD', 'ORDER', 'STEPS'), help='solver the FMeasure delta is computed against')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    config._dict['MODE'] = 0
+    config._dict['DPM_SOLVER'] = 'True'
+    tester = Tester(config)
+    tester.load_checkpoints()
+    skip_type = args.skip_type if args.skip_type else tester.dpm_skip_type
+
+    reference = (args.reference[0], int(args.reference[1]), int(args.reference[2]), 1.)
+    grid = [reference] + [(method, order, steps, t_start) for method, order, steps, t_start in
+                          itertools.product(args.methods, args.orders, args.steps, args.t_start)
+                          if method != 'adaptive' and steps >= order and (method, order, steps, t_start) != reference]
+    grid += [('adaptive', order, max_nfe, t_start) for order, max_nfe, t_start in
+             itertools.product(args.orders, args.max_nfe, args.t_start)
+             if 'adaptive' in args.methods and order in [2, 3] and max_nfe >= order]
+    print('{:<12}{:>6}{:>6}{:>8}{:>7}{:>11}{:>11}{:>9}{:>9}{:>10}{:>10}'.format(
+        'method', 'order', 'steps', 't_start', 'NFE', 'FMeasure', 'PFMeasure', 'PSNR', 'DRD', 'dFM', 'Time (s)'))
+    reference_fmeasure = None
+    for method, order, steps, t_start in grid:
+        #FOR 'adaptive' THE steps COLUMN IS THE NFE BUDGET AND NFE THE MEAN PER BATCH
+        tester.solver_plan = build_solver(tester.schedule.get_betas(), steps, method=method, order=order,
+                                          skip_type=skip_type, thresholding_method=tester.dpm_thresholding,
+                                          atol=tester.dpm_tolerance[0], rtol=tester.dpm_tolerance[1], max_nfe=steps,
+                                          t_start=t_start)
+        tester.nfe_stats.update(batches=0, nfe=0, tiles=0, tile_evals=0, reused=0)
+        metrics, elapsed = evaluate(tester, args.r_weights, args.p_weights)
+        nfe = tester.nfe_stats['nfe'] / max(tester.nfe_stats['batches'], 1)
+        reference_fmeasure = metrics[0] if reference_fmeasure is None else reference_fmeasure
+        print('{:<12}{:>6}{:>6}{:>8.2f}{:>7.1f}{:>11.4f}{:>11.4f}{:>9.4f}{:>9.4f}{:>+10.4f}{:>10.2f}'.format(
+            method, order, steps, t_start, nfe, *metrics, metrics[0] - reference_fmeasure, elapsed))